@@ -0,0 +1,252 @@
+"""
+Message Archive
+
+Cold storage for aged chat messages. Messages older than
+MESSAGE_ARCHIVE_AFTER_DAYS are moved out of `message` (and `messagebucket`)
+into `messagearchive` as compressed chunks of one conversation each:
+
+    {_id, character_id, owner, count, first_at, last_at, archived_at, codec, data}
+
+`data` is the zlib-compressed BSON of the chunk's messages, so the hot
+collections (and their indexes) only hold recent conversations. Archived
+chunks stay readable through GET /archive/chat/{character_id}/messages and
+expire with MESSAGE_RETENTION_DAYS like the hot messages.
+
+The job runs in the background every ARCHIVE_INTERVAL_SECONDS, or once with:
+
+    python archive.py run
+
+Every worker schedules it, but a run first takes a lease in `joblock`, so
+only one process archives at a time. Hot messages are deleted only once an
+archive chunk verifiably holds them, so an overlapping or interrupted run
+never loses data.
+"""
+
+import logging
+import os
+import sys
+import threading
+import zlib
+from uuid import uuid4
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+import bson
+from bson.binary import Binary
+from pymongo.errors import DuplicateKeyError
+
+import database
+from database import iter_documents
+from message_store import BUCKET_COLLECTION, BucketPager, bucket_page_query
+from services import build_message_page, message_dict
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("MESSAGE_ARCHIVE_AFTER_DAYS", 0))
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", 3600))
+ARCHIVE_CHUNK_SIZE = int(os.getenv("ARCHIVE_CHUNK_SIZE", 500))
+ARCHIVE_LEASE_SECONDS = int(os.getenv("ARCHIVE_LEASE_SECONDS", 900))
+ARCHIVE_COLLECTION = "messagearchive"
+ARCHIVE_CODEC = "bson+zlib"
+LOCK_COLLECTION = "joblock"
+
+
+def pack(messages: List[dict]) -> Binary:
+    return Binary(zlib.compress(bson.encode({"messages": messages}), 6))
+
+
+def unpack(chunk: dict) -> dict:
+    """Archive chunk -> bucket-shaped dict with its messages decompressed"""
+    messages = bson.decode(zlib.decompress(chunk["data"]))["messages"]
+    return {"first_at": chunk["first_at"], "last_at": chunk["last_at"], "messages": messages}
+
+
+def archive_chunk(messages: List[dict]) -> dict:
+    """One conversation's messages (chronological) as an archive document"""
+    first = messages[0]
+    return {
+        # Keyed by the first message, so a rerun finds it (see store_chunk)
+        "_id": f"archive-{first['_id']}",
+        "character_id": first["character_id"],
+        "owner": first.get("owner"),
+        "count": len(messages),
+        "first_at": messages[0]["created_at"],
+        "last_at": messages[-1]["created_at"],
+        "archived_at": datetime.now(timezone.utc),
+        "codec": ARCHIVE_CODEC,
+        "data": pack(messages),
+    }
+
+
+def store_chunk(messages: List[dict], stats: dict) -> List[str]:
+    """Archive one conversation's messages (chronological); returns the _ids the archive now holds.
+
+    A chunk with the same first message may already exist from an earlier or
+    overlapping run, holding fewer messages: whatever it lacks goes into a
+    chunk of its own.
+    """
+    collection = database.get_db()[ARCHIVE_COLLECTION]
+    chunk = archive_chunk(messages)
+    try:
+        collection.insert_one(chunk)
+        stats["chunks"] += 1
+        return [m["_id"] for m in messages]
+    except DuplicateKeyError:
+        pass
+    existing = collection.find_one({"_id": chunk["_id"]})
+    held = {m["_id"] for m in unpack(existing)["messages"]} if existing else set()
+    rest = [m for m in messages if m["_id"] not in held]
+    if not rest:
+        stats["skipped"] += 1
+        return [m["_id"] for m in messages]
+    if len(rest) == len(messages):
+        return []  # nothing verifiably archived; left for the next run
+    return [m["_id"] for m in messages if m["_id"] in held] + store_chunk(rest, stats)
+
+
+def acquire_lease(name: str, owner: str, seconds: int) -> bool:
+    """Take (or renew) the named lease unless another owner holds an unexpired one"""
+    now = datetime.now(timezone.utc)
+    try:
+        database.get_db()[LOCK_COLLECTION].update_one(
+            {"_id": name, "$or": [{"locked_until": {"$lt": now}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "locked_until": now + timedelta(seconds=seconds)}},
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+def release_lease(name: str, owner: str) -> None:
+    database.get_db()[LOCK_COLLECTION].delete_one({"_id": name, "owner": owner})
+
+
+def run_archive(now: Optional[datetime] = None, after_days: Optional[int] = None) -> dict:
+    """Move messages older than the cutoff into the archive, unless another process is already at it"""
+    db = database.get_db()
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    after_days = ARCHIVE_AFTER_DAYS if after_days is None else after_days
+    stats = {"messages": 0, "chunks": 0, "skipped": 0, "busy": False}
+    if after_days <= 0:
+        return stats
+    owner = str(uuid4())
+    if not acquire_lease("archive", owner, ARCHIVE_LEASE_SECONDS):
+        stats["busy"] = True
+        return stats
+    try:
+        cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=after_days)
+        archive_documents(cutoff, stats)
+        archive_buckets(cutoff, stats)
+    finally:
+        release_lease("archive", owner)
+    return stats
+
+
+def archive_documents(cutoff: datetime, stats: dict) -> None:
+    """One document per message: walk aged messages conversation by conversation"""
+    db = database.get_db()
+
+    def flush(batch: List[dict]) -> None:
+        held = store_chunk(batch, stats)
+        if held:
+            stats["messages"] += db["message"].delete_many({"_id": {"$in": held}}).deleted_count
+
+    batch, conversation = [], None
+    docs = iter_documents(
+        "message",
+        {"created_at": {"$lt": cutoff}},
+        sort=[("owner", 1), ("character_id", 1), ("created_at", 1), ("_id", 1)],
+    )
+    for doc in docs:
+        key = (doc.get("owner"), doc["character_id"])
+        if batch and (key != conversation or len(batch) >= ARCHIVE_CHUNK_SIZE):
+            flush(batch)
+            batch = []
+        conversation = key
+        batch.append(doc)
+    if batch:
+        flush(batch)
+
+
+def archive_buckets(cutoff: datetime, stats: dict) -> None:
+    """Buckets whose newest message is past the cutoff move whole"""
+    db = database.get_db()
+    for bucket in iter_documents(BUCKET_COLLECTION, {"last_at": {"$lt": cutoff}}):
+        messages = sorted(bucket["messages"], key=lambda m: (m["created_at"], m["_id"]))
+        if not messages:
+            continue
+        if len(store_chunk(messages, stats)) < len(messages):
+            continue
+        # Only remove the bucket if nothing was appended to it meanwhile. One
+        # that was stays hot; its archived part is recognised when it ages again.
+        if db[BUCKET_COLLECTION].delete_one({"_id": bucket["_id"], "count": bucket["count"]}).deleted_count:
+            stats["messages"] += len(messages)
+
+
+def page(base: dict, limit: int, before: Optional[str], after: Optional[str]) -> dict:
+    """One keyset page (MessagePage content) of a conversation's archived messages"""
+    query, sort, direction, lower, upper = bucket_page_query(base, before, after)
+    pager = BucketPager(limit, direction, lower, upper)
+    with database.get_db()[ARCHIVE_COLLECTION].find(query, sort=sort, batch_size=4) as cursor:
+        for chunk in cursor:
+            if not pager.feed(unpack(chunk)):
+                break
+    return build_message_page([message_dict(m) for m in pager.items], limit, direction, before, after)
+
+
+async def apage(base: dict, limit: int, before: Optional[str], after: Optional[str]) -> dict:
+    import async_database
+    query, sort, direction, lower, upper = bucket_page_query(base, before, after)
+    pager = BucketPager(limit, direction, lower, upper)
+    cursor = async_database.get_db()[ARCHIVE_COLLECTION].find(query, sort=sort, batch_size=4)
+    try:
+        async for chunk in cursor:
+            if not pager.feed(unpack(chunk)):
+                break
+    finally:
+        await cursor.close()
+    return build_message_page([message_dict(m) for m in pager.items], limit, direction, before, after)
+
+
+class ArchiveScheduler:
+    """Runs run_archive every `interval` seconds on a daemon thread"""
+
+    def __init__(self, interval: int = ARCHIVE_INTERVAL_SECONDS, after_days: int = ARCHIVE_AFTER_DAYS):
+        self.interval = interval
+        self.after_days = after_days
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None or self.interval <= 0 or self.after_days <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="message-archive", daemon=True)
+        self._thread.start()
+
+    def shutdown(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _loop(self) -> None:
+        # Every worker schedules the job; the lease in run_archive lets one of them run it
+        while not self._stop.wait(self.interval):
+            try:
+                stats = run_archive(after_days=self.after_days)
+                if stats["messages"]:
+                    logger.info("Archived %d messages in %d chunks", stats["messages"], stats["chunks"])
+            except Exception:
+                logger.exception("Message archival failed")
+
+
+archiver = ArchiveScheduler()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["run"]:
+        sys.exit("usage: python archive.py run")
+    print(run_archive())
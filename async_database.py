@@ -0,0 +1,152 @@
+"""
+Async Database Helper Functions
+
+Motor (asyncio) counterpart of database.py for the async routes. Uses the same
+DATABASE_URL / DATABASE_NAME settings; select it with DB_DRIVER=async.
+"""
+
+from datetime import datetime, timezone
+import asyncio
+import os
+import time
+from dotenv import load_dotenv
+from typing import AsyncIterator, List, Optional, Sequence, Tuple, Union
+from pydantic import BaseModel
+from pymongo import WriteConcern
+
+from database import PoolStats, client_options
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:  # motor is only needed when DB_DRIVER=async
+    AsyncIOMotorClient = None
+
+# Load environment variables from .env file
+load_dotenv()
+
+database_url = os.getenv("DATABASE_URL")
+database_name = os.getenv("DATABASE_NAME")
+
+# The motor client's own pool counters (the sync client keeps database.pool_stats)
+pool_stats = PoolStats()
+
+# Per-process and created on first use, like database.get_client
+_client = None
+_db = None
+_client_pid = None
+
+
+def get_client():
+    """This process's AsyncIOMotorClient; None when not configured or motor is missing"""
+    global _client, _db, _client_pid
+    if not (database_url and database_name) or AsyncIOMotorClient is None:
+        return None
+    if _client_pid != os.getpid():
+        if _client is not None:
+            pool_stats.reset()  # inherited from the parent
+        _client = AsyncIOMotorClient(database_url, **client_options(pool_stats))
+        _db = _client[database_name]
+        _client_pid = os.getpid()
+    return _client
+
+
+def get_db():
+    if _client_pid != os.getpid():
+        get_client()
+    return _db
+
+
+async def warm_up(timeout: float = 5.0) -> int:
+    """Async counterpart of database.warm_up"""
+    client = get_client()
+    if client is None:
+        return 0
+    await client.admin.command("ping")
+    target = client.options.pool_options.min_pool_size
+    deadline = time.monotonic() + timeout
+    while pool_stats.open < target and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return pool_stats.open
+
+
+def close_client() -> None:
+    global _client, _db, _client_pid
+    if _client is not None and _client_pid == os.getpid():
+        _client.close()
+    _client = _db = _client_pid = None
+
+# Helper functions for common database operations
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
+    """Insert a single document with timestamp"""
+    db = get_db()
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    # Convert Pydantic model to dict if needed
+    if isinstance(data, BaseModel):
+        data_dict = data.model_dump()
+    else:
+        data_dict = data.copy()
+
+    data_dict['created_at'] = datetime.now(timezone.utc)
+    data_dict['updated_at'] = datetime.now(timezone.utc)
+
+    result = await db[collection_name].insert_one(data_dict)
+    return str(result.inserted_id)
+
+async def create_documents(collection_name: str, data_list: List[Union[BaseModel, dict]],
+                           write_concern: Optional[WriteConcern] = None):
+    """Insert several documents in one ordered round-trip (see database.create_documents)"""
+    db = get_db()
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    now = datetime.now(timezone.utc)
+    documents = []
+    for data in data_list:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else data
+        data_dict.setdefault('created_at', now)
+        data_dict.setdefault('updated_at', now)
+        documents.append(data_dict)
+
+    collection = db[collection_name]
+    if write_concern is not None:
+        collection = collection.with_options(write_concern=write_concern)
+    result = await collection.insert_many(documents, ordered=True)
+    return [str(inserted_id) for inserted_id in result.inserted_ids]
+
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+    """Get documents from collection"""
+    db = get_db()
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    cursor = db[collection_name].find(filter_dict or {})
+    if limit:
+        cursor = cursor.limit(limit)
+
+    return await cursor.to_list(length=None)
+
+async def aiter_documents(collection_name: str, filter_dict: dict = None, projection: dict = None,
+                          sort: Sequence[Tuple[str, int]] = None, skip: int = 0, limit: int = None,
+                          batch_size: int = 1000, max_time_ms: int = None) -> AsyncIterator[dict]:
+    """Async counterpart of database.iter_documents: yield documents one batch at a time"""
+    db = get_db()
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    cursor = db[collection_name].find(filter_dict or {}, projection, batch_size=batch_size)
+    if sort:
+        cursor = cursor.sort(list(sort))
+    if skip:
+        cursor = cursor.skip(skip)
+    if limit:
+        cursor = cursor.limit(limit)
+    if max_time_ms:
+        cursor = cursor.max_time_ms(max_time_ms)
+
+    try:
+        async for doc in cursor:
+            yield doc
+    finally:
+        await cursor.close()
@@ -0,0 +1,384 @@
+"""
+Async Routes
+
+async def versions of every route in main.py, backed by motor through
+async_database.py. Mounted instead of the sync routes when DB_DRIVER=async,
+so a request waiting on MongoDB does not hold a threadpool thread.
+"""
+
+import os
+from datetime import datetime
+from typing import List, Literal, Optional, Union
+
+from fastapi import APIRouter, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from async_database import get_db
+from cache import character_cache, character_list_cache, character_list_async_flight
+from image_jobs import image_jobs, image_results
+import archive
+import message_store
+from rendering import render
+from schemas import BulkUpsertResult, UserProfile, Character, ImageRequest, ImageJobOut, CharacterOut, CharacterPage, MessageOut, MessagePage
+from services import (
+    CHARACTER_LIST_ADAPTER,
+    CHARACTER_PAGE_ADAPTER,
+    CHARACTER_SHAPE,
+    CHARACTER_SORT,
+    BULK_USERS_MAX,
+    DEFAULT_PAGE_SIZE,
+    MESSAGE_LIST_ADAPTER,
+    MESSAGE_PAGE_ADAPTER,
+    NDJSONEncoder,
+    PROFILE_PROJECTION,
+    SSE_HEADERS,
+    ChatIn,
+    ThreadMessageIn,
+    abuild_turn,
+    build_character_page,
+    character_dict,
+    character_page_query,
+    export_filename,
+    export_query,
+    export_sort,
+    image_job_out,
+    message_dict,
+    andjson_chunks,
+    new_character_doc,
+    new_character_message,
+    new_image_job,
+    new_user_message,
+    profile_out,
+    profile_upsert,
+    reply_generator,
+    resolve_return_mode,
+    shaped_pipeline,
+    sse_event,
+    wants_page,
+)
+
+router = APIRouter()
+
+
+# Health
+@router.get("/")
+async def root():
+    return {"message": "Backend running", "database": get_db() is not None}
+
+
+@router.get("/test")
+async def test_database():
+    db = get_db()
+    response = {
+        "backend": "✅ Running",
+        "database": "❌ Not Available" if db is None else "✅ Connected",
+        "database_url": "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set",
+        "database_name": os.getenv("DATABASE_NAME") or None,
+        "driver": "async",
+        "collections": [],
+    }
+    try:
+        if db is not None:
+            response["collections"] = (await db.list_collection_names())[:10]
+    except Exception as e:
+        response["database"] = f"⚠️ Error: {str(e)[:80]}"
+    return response
+
+
+# Users
+@router.post("/users", response_model=UserProfile)
+async def upsert_user(profile: UserProfile):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    query, update = profile_upsert(profile)
+    try:
+        doc = await db["userprofile"].find_one_and_update(
+            query, update, projection=PROFILE_PROJECTION, upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        # A concurrent request inserted the same username first; update its document
+        doc = await db["userprofile"].find_one_and_update(
+            query, update, projection=PROFILE_PROJECTION, return_document=ReturnDocument.AFTER)
+    return profile_out(doc)
+
+
+@router.post("/users/bulk", response_model=BulkUpsertResult)
+async def upsert_users_bulk(profiles: List[UserProfile]):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    if len(profiles) > BULK_USERS_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_USERS_MAX} profiles per request")
+    result = BulkUpsertResult(received=len(profiles), matched=0, modified=0, upserted=0)
+    if not profiles:
+        return result
+    ops = [UpdateOne(*profile_upsert(profile), upsert=True) for profile in profiles]
+    try:
+        outcome = (await db["userprofile"].bulk_write(ops, ordered=False)).bulk_api_result
+    except BulkWriteError as e:
+        outcome = e.details
+        # Upserts that lost a race with a concurrent insert are retried once
+        retry = [ops[err["index"]] for err in outcome["writeErrors"] if err["code"] == 11000]
+        if len(retry) < len(outcome["writeErrors"]):
+            raise HTTPException(status_code=500, detail=outcome["writeErrors"][0]["errmsg"][:200])
+        retried = (await db["userprofile"].bulk_write(retry, ordered=False)).bulk_api_result
+        for key in ("nMatched", "nModified", "nUpserted"):
+            outcome[key] += retried[key]
+    result.matched = outcome["nMatched"]
+    result.modified = outcome["nModified"]
+    result.upserted = outcome["nUpserted"]
+    return result
+
+
+@router.get("/users/{username}", response_model=UserProfile)
+async def get_user(username: str):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    doc = await db["userprofile"].find_one({"username": username})
+    if not doc:
+        raise HTTPException(status_code=404, detail="User not found")
+    return profile_out(doc)
+
+
+# Characters
+@router.post("/characters", response_model=CharacterOut)
+async def create_character(character: Character):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    data = new_character_doc(character)
+    await db["character"].insert_one(data)
+    character_cache.set(data["_id"], data)
+    character_list_cache.clear()
+    return character_dict(data)
+
+
+@router.get("/characters", response_model=Union[CharacterPage, List[CharacterOut]])
+async def list_characters(
+    limit: Optional[int] = Query(None, ge=1, le=200, description=f"Page size (default {DEFAULT_PAGE_SIZE})"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    x_api_version: int = Header(1),
+):
+    """A CharacterPage for API v2 or when paging; API v1 clients otherwise get every character as a list"""
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    paged = wants_page(x_api_version, limit, cursor)
+    limit = limit or DEFAULT_PAGE_SIZE
+    key = (limit, cursor) if paged else None
+    adapter = CHARACTER_PAGE_ADAPTER if paged else CHARACTER_LIST_ADAPTER
+    page = character_list_cache.get(key)
+    if page is not None:
+        return render(page, adapter)
+
+    async def load():
+        docs = await db["character"].aggregate(
+            shaped_pipeline(character_page_query(cursor), CHARACTER_SORT, limit + 1 if paged else None, CHARACTER_SHAPE)
+        ).to_list(length=None)
+        result = build_character_page(docs, limit) if paged else docs
+        character_list_cache.set(key, result)
+        return result
+
+    # Concurrent identical requests share a single query
+    return render(await character_list_async_flight.do(key, load), adapter)
+
+
+async def load_character(character_id: str) -> Optional[dict]:
+    """Character document through the shared cache; misses are not cached"""
+    char = character_cache.get(character_id)
+    if char is None:
+        char = await get_db()["character"].find_one({"_id": character_id})
+        if char:
+            character_cache.set(character_id, char)
+    return char
+
+
+# Chat messages
+@router.post("/chat/{character_id}/messages", response_model=List[MessageOut])
+async def post_message(
+    character_id: str,
+    payload: ChatIn,
+    return_mode: Optional[Literal["delta", "full"]] = Query(None, alias="return"),
+    x_api_version: int = Header(1),
+):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    char = await load_character(character_id)
+    if not char:
+        raise HTTPException(status_code=404, detail="Character not found")
+
+    user_msg, char_msg = await abuild_turn(char, character_id, payload)
+    # Both messages in one round-trip; ordered so the reply never lands without the user message
+    await message_store.aappend([user_msg, char_msg])
+
+    if resolve_return_mode(return_mode, x_api_version) == "delta":
+        msgs = [message_dict(user_msg), message_dict(char_msg)]
+    else:
+        msgs = await message_store.ahistory({"character_id": character_id})
+    return render(msgs, MESSAGE_LIST_ADAPTER)
+
+
+@router.post("/chat/{character_id}/messages/stream")
+async def stream_message(character_id: str, payload: ChatIn):
+    """Server-Sent Events: `message` (stored user message), `token`* (reply chunks), then `done` (stored reply)"""
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    char = await load_character(character_id)
+    if not char:
+        raise HTTPException(status_code=404, detail="Character not found")
+
+    user_msg = new_user_message(character_id, payload)
+    await message_store.aappend([user_msg])
+
+    async def events():
+        yield sse_event("message", message_dict(user_msg))
+        chunks = []
+        try:
+            async for chunk in reply_generator.astream(char, payload.text):
+                chunks.append(chunk)
+                yield sse_event("token", {"text": chunk})
+        except Exception as e:
+            yield sse_event("error", {"detail": str(e)[:200]})
+            return
+        # Persisted only once the reply is complete
+        char_msg = new_character_message(char, character_id, "".join(chunks), user_msg)
+        await message_store.aappend([char_msg])
+        yield sse_event("done", message_dict(char_msg))
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@router.get("/chat/{character_id}/messages", response_model=Union[MessagePage, List[MessageOut]])
+async def get_messages(
+    character_id: str,
+    limit: Optional[int] = Query(None, ge=1, le=500, description=f"Page size (default {DEFAULT_PAGE_SIZE})"),
+    before: Optional[str] = Query(None, description="Cursor: return messages older than this position"),
+    after: Optional[str] = Query(None, description="Cursor: return messages newer than this position"),
+    x_api_version: int = Header(1),
+):
+    """A MessagePage for API v2 or when paging; API v1 clients otherwise get the whole conversation as a list"""
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    if not wants_page(x_api_version, limit, before, after):
+        return render(await message_store.ahistory({"character_id": character_id}), MESSAGE_LIST_ADAPTER)
+    page = await message_store.apage({"character_id": character_id}, limit or DEFAULT_PAGE_SIZE, before, after)
+    return render(page, MESSAGE_PAGE_ADAPTER)
+
+
+# Per-user conversation threads: only this user's turns with the character
+@router.post("/users/{username}/chats/{character_id}/messages", response_model=List[MessageOut])
+async def post_thread_message(username: str, character_id: str, payload: ThreadMessageIn):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    char = await load_character(character_id)
+    if not char:
+        raise HTTPException(status_code=404, detail="Character not found")
+
+    user_msg, char_msg = await abuild_turn(char, character_id, ChatIn(username=username, text=payload.text))
+    await message_store.aappend([user_msg, char_msg])
+    return render([message_dict(user_msg), message_dict(char_msg)], MESSAGE_LIST_ADAPTER)
+
+
+@router.get("/users/{username}/chats/{character_id}/messages", response_model=MessagePage)
+async def get_thread_messages(
+    username: str,
+    character_id: str,
+    limit: int = Query(50, ge=1, le=500),
+    before: Optional[str] = Query(None, description="Cursor: return messages older than this position"),
+    after: Optional[str] = Query(None, description="Cursor: return messages newer than this position"),
+):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    page = await message_store.apage(message_store.conversation_filter(character_id, owner=username), limit, before, after)
+    return render(page, MESSAGE_PAGE_ADAPTER)
+
+
+# Export
+@router.get("/export/messages")
+async def export_messages(
+    character_id: Optional[str] = None,
+    username: Optional[str] = Query(None, description="Sender of the message"),
+    owner: Optional[str] = Query(None, description="User whose conversation threads to export"),
+    since: Optional[datetime] = Query(None, description="Only messages created at or after this time"),
+    until: Optional[datetime] = Query(None, description="Only messages created before this time"),
+    gzip: bool = Query(False, description="Compress the stream with gzip"),
+    batch_size: int = Query(1000, ge=1, le=10000),
+):
+    """Stream matching messages as NDJSON straight from the cursor, in constant memory"""
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    docs = message_store.aexport(
+        export_query(character_id, username, since, until, owner),
+        sort=export_sort(character_id),
+        batch_size=batch_size,
+    )
+    encoder = NDJSONEncoder(compress=gzip)
+    return StreamingResponse(andjson_chunks(docs, encoder), media_type=encoder.media_type, headers=export_filename(gzip))
+
+
+# Archived (cold) messages, read-only
+@router.get("/archive/chat/{character_id}/messages", response_model=MessagePage)
+async def get_archived_messages(
+    character_id: str,
+    owner: Optional[str] = Query(None, description="Only this user's conversation thread"),
+    limit: int = Query(50, ge=1, le=500),
+    before: Optional[str] = Query(None, description="Cursor: return messages older than this position"),
+    after: Optional[str] = Query(None, description="Cursor: return messages newer than this position"),
+):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    page = await archive.apage(message_store.conversation_filter(character_id, owner=owner), limit, before, after)
+    return render(page, MESSAGE_PAGE_ADAPTER)
+
+
+# Image generation: jobs are persisted and rendered by the image_jobs worker pool
+@router.post("/images", response_model=ImageJobOut, status_code=202)
+async def generate_image(req: ImageRequest, response: Response):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+
+    # Fetch character and user
+    char = await load_character(req.character_id)
+    if not char:
+        raise HTTPException(status_code=404, detail="Character not found")
+    user = await db["userprofile"].find_one({"username": req.username})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    job = new_image_job(char, req)
+    if job["status"] == "queued":
+        # Identical requests reuse the earlier result instead of regenerating
+        cached_url = image_results.get_local(job["cache_key"]) or await run_in_threadpool(image_results.get, job["cache_key"])
+        if cached_url:
+            job.update(status="completed", image_url=cached_url, message="SFW image created (cached)")
+        else:
+            job["leased_until"] = image_jobs.lease()
+    await db["imagejob"].insert_one(job)
+    if job["status"] == "queued":
+        image_jobs.submit(job)
+    else:
+        response.status_code = 200  # cached or blocked: nothing left to do
+    return image_job_out(job)
+
+
+@router.get("/images/{job_id}", response_model=ImageJobOut)
+async def get_image_job(job_id: str):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    job = await db["imagejob"].find_one({"_id": job_id})
+    if not job:
+        raise HTTPException(status_code=404, detail="Image job not found")
+    return image_job_out(job)
@@ -0,0 +1,82 @@
+"""
+Microbenchmark: turning message documents into response items
+
+Compares the two per-document conversions the app uses to render a
+conversation:
+
+    dict per doc   message_dict(): one new dict per document (bucket layout, archive)
+    server shape   MESSAGE_SHAPE: MongoDB returns documents already shaped (document layout)
+
+Reports wall time, allocated blocks still held afterwards and peak traced
+memory for each. Run from the repository root:
+
+    python -m benchmarks.doc_rendering [count]
+"""
+
+import gc
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from services import message_dict
+
+
+def make_docs(count: int, shaped: bool = False) -> list:
+    start = datetime(2024, 1, 1)
+    docs = []
+    for i in range(count):
+        doc = {
+            "_id": str(uuid4()),
+            "character_id": "c0ffee00-0000-4000-8000-000000000000",
+            "username": "someone" if i % 2 else "Character",
+            "text": f"message number {i}",
+            "role": "user" if i % 2 else "character",
+            "created_at": start + timedelta(milliseconds=i),
+            "updated_at": start + timedelta(milliseconds=i),
+        }
+        if shaped:
+            doc = {"id": doc.pop("_id"), **{k: doc[k] for k in ("character_id", "username", "text", "role", "created_at")}}
+        docs.append(doc)
+    return docs
+
+
+def dict_per_doc(docs):
+    return [message_dict(m) for m in docs]
+
+
+def server_shaped(docs):
+    return docs
+
+
+def measure(fn, docs):
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn(docs)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    blocks = sys.getallocatedblocks() - blocks_before
+    del result
+    return elapsed, blocks, peak
+
+
+def main(count: int = 50_000) -> None:
+    cases = [
+        ("dict per doc", dict_per_doc, False),
+        ("server shape", server_shaped, True),
+    ]
+    print(f"{count} documents")
+    print(f"{'path':<14} {'ms':>9} {'new blocks':>11} {'peak KiB':>10}")
+    for name, fn, shaped in cases:
+        docs = make_docs(count, shaped)
+        elapsed, blocks, peak = measure(fn, docs)
+        print(f"{name:<14} {elapsed * 1000:>9.1f} {blocks:>11} {peak / 1024:>10.0f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
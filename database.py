@@ -5,29 +5,458 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient, WriteConcern
+from pymongo.errors import OperationFailure
+from pymongo.monitoring import CommandListener, ConnectionPoolListener
+from collections import deque
 from datetime import datetime, timezone
+import logging
 import os
+import random
+import threading
+import time
 from dotenv import load_dotenv
-from typing import Union
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
 from pydantic import BaseModel
 
+from metrics import current_route, registry
+
+logger = logging.getLogger(__name__)
+
 # Load environment variables from .env file
 load_dotenv()
 
-_client = None
-db = None
+class PoolStats(ConnectionPoolListener):
+    """Connection pool counters, so pool starvation can be told apart from a slow server"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.open = 0
+            self.checked_out = 0
+            self.waiting = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.pool_clears = 0
+            self.checkout_seconds_total = 0.0
+            self.checkout_seconds_max = 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "open_connections": self.open,
+                "checked_out": self.checked_out,
+                "wait_queue": self.waiting,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "pool_clears": self.pool_clears,
+                "checkout_ms_avg": round(self.checkout_seconds_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+                "checkout_ms_max": round(self.checkout_seconds_max * 1000, 3),
+            }
+
+    # A checkout starts and finishes on the same thread
+    def _checkout_finished(self):
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        return time.perf_counter() - started if started is not None else 0.0
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+
+    def connection_checked_out(self, event):
+        elapsed = self._checkout_finished()
+        with self._lock:
+            self.waiting -= 1
+            self.checked_out += 1
+            self.checkouts += 1
+            self.checkout_seconds_total += elapsed
+            self.checkout_seconds_max = max(self.checkout_seconds_max, elapsed)
+
+    def connection_check_out_failed(self, event):
+        self._checkout_finished()
+        with self._lock:
+            self.waiting -= 1
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+pool_stats = PoolStats()
+
+
+def _pool_gauges() -> dict:
+    snapshot = pool_stats.snapshot()
+    return {(state,): snapshot[key] for state, key in
+            (("open", "open_connections"), ("checked_out", "checked_out"), ("waiting", "wait_queue"))}
+
+
+registry.gauge("mongodb_pool_connections", "Pooled connections by state (waiting = requests queued for one)",
+               ("state",), collect=_pool_gauges)
+registry.counter("mongodb_pool_checkouts_total", "Connection checkouts",
+                 collect=lambda: {(): pool_stats.checkouts})
+registry.counter("mongodb_pool_checkout_failures_total", "Connection checkouts that timed out or errored",
+                 collect=lambda: {(): pool_stats.checkout_failures})
+registry.counter("mongodb_pool_checkout_seconds_total", "Time spent waiting for a pooled connection",
+                 collect=lambda: {(): pool_stats.checkout_seconds_total})
+
+
+# Commands whose latency says nothing about the app's queries
+_UNMONITORED_COMMANDS = {"hello", "ismaster", "isMaster", "ping", "buildInfo", "endSessions",
+                         "saslStart", "saslContinue", "authenticate"}
+
+# Where each command keeps its query, for the redacted shape in the slow log
+_QUERY_FIELDS = {"find": "filter", "aggregate": "pipeline", "findAndModify": "query",
+                 "count": "query", "distinct": "query"}
+
+
+def query_shape(value):
+    """Query with every literal replaced by "?", keeping field names and operators"""
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(v, dict) for v in value):
+            return [query_shape(v) for v in value]
+        return ["?"] if value else []
+    return "?"
+
+
+def command_query(name: str, command: dict):
+    if name in _QUERY_FIELDS:
+        return command.get(_QUERY_FIELDS[name])
+    if name in ("update", "delete"):
+        statements = command.get("updates" if name == "update" else "deletes") or [{}]
+        return statements[0].get("q")
+    return None
+
+
+class CommandStats(CommandListener):
+    """Per collection/command latency histograms plus a sampled log of slow commands"""
+
+    def __init__(self, slow_ms: float = 100, sample_rate: float = 1.0, log_size: int = 100):
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.slow = deque(maxlen=log_size)
+        self.latency = registry.histogram(
+            "mongodb_command_duration_seconds", "MongoDB command round-trip time", ("collection", "command"))
+        self.failures = registry.counter(
+            "mongodb_command_failures_total", "MongoDB commands that returned an error", ("collection", "command"))
+        self.slow_commands = registry.counter(
+            "mongodb_slow_commands_total", "MongoDB commands slower than SLOW_COMMAND_MS", ("collection", "command"))
+
+    def started(self, event):
+        if event.command_name in _UNMONITORED_COMMANDS:
+            return
+        command = event.command
+        collection = command.get("collection") if event.command_name == "getMore" else command.get(event.command_name)
+        pending = (str(collection) if isinstance(collection, str) else "-", command, current_route())
+        with self._lock:
+            self._pending[(event.request_id, event.connection_id)] = pending
+
+    def _finished(self, event, failed: bool):
+        with self._lock:
+            pending = self._pending.pop((event.request_id, event.connection_id), None)
+        if pending is None:
+            return
+        collection, command, route = pending
+        seconds = event.duration_micros / 1e6
+        self.latency.observe(seconds, collection, event.command_name)
+        if failed:
+            self.failures.inc(collection, event.command_name)
+        if seconds * 1000 >= self.slow_ms:
+            self.slow_commands.inc(collection, event.command_name)
+            if random.random() < self.sample_rate:
+                self.slow.append({
+                    "at": datetime.now(timezone.utc).isoformat(),
+                    "command": event.command_name,
+                    "collection": collection,
+                    "duration_ms": round(seconds * 1000, 3),
+                    "ok": not failed,
+                    "query_shape": query_shape(command_query(event.command_name, command)),
+                    "route": route,
+                })
+
+    def succeeded(self, event):
+        self._finished(event, failed=False)
+
+    def failed(self, event):
+        self._finished(event, failed=True)
+
+    def slow_log(self) -> list:
+        """Newest first"""
+        return list(reversed(self.slow))
+
+
+command_stats = CommandStats(
+    slow_ms=float(os.getenv("SLOW_COMMAND_MS", 100)),
+    sample_rate=float(os.getenv("SLOW_COMMAND_SAMPLE_RATE", 1.0)),
+    log_size=int(os.getenv("SLOW_COMMAND_LOG_SIZE", 100)),
+)
+
+
+def _env_int(name: str):
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else None
+
+
+def client_options(stats: Optional[PoolStats] = None) -> dict:
+    """MongoClient keyword arguments from MONGO_* environment variables (unset ones keep driver defaults).
+
+    Each client needs its own PoolStats (`stats`, default: the sync client's)
+    so that its pool is counted on its own.
+    """
+    options = {
+        "maxPoolSize": _env_int("MONGO_MAX_POOL_SIZE"),
+        "minPoolSize": _env_int("MONGO_MIN_POOL_SIZE"),
+        "maxIdleTimeMS": _env_int("MONGO_MAX_IDLE_TIME_MS"),
+        "waitQueueTimeoutMS": _env_int("MONGO_WAIT_QUEUE_TIMEOUT_MS"),
+        "serverSelectionTimeoutMS": _env_int("MONGO_SERVER_SELECTION_TIMEOUT_MS"),
+        "connectTimeoutMS": _env_int("MONGO_CONNECT_TIMEOUT_MS"),
+        "socketTimeoutMS": _env_int("MONGO_SOCKET_TIMEOUT_MS"),
+    }
+    options = {k: v for k, v in options.items() if v is not None}
+    if os.getenv("MONGO_COMPRESSORS"):
+        options["compressors"] = os.getenv("MONGO_COMPRESSORS")  # e.g. "zstd,snappy"
+    if os.getenv("MONGO_RETRY_WRITES"):
+        options["retryWrites"] = os.getenv("MONGO_RETRY_WRITES").lower() in ("1", "true", "yes")
+    options["event_listeners"] = [stats or pool_stats, command_stats]
+    return options
+
+
+def write_concern_from_env(prefix: str) -> Optional[WriteConcern]:
+    """WriteConcern from <prefix>_W / _J / _WTIMEOUT_MS; None when none are set (use the client default)"""
+    w = os.getenv(f"{prefix}_W")
+    j = os.getenv(f"{prefix}_J")
+    wtimeout = _env_int(f"{prefix}_WTIMEOUT_MS")
+    if w is None and j is None and wtimeout is None:
+        return None
+    return WriteConcern(
+        w=int(w) if w and w.isdigit() else w,
+        j=j.lower() in ("1", "true", "yes") if j is not None else None,
+        wtimeout=wtimeout,
+    )
+
+
+# Write concern for chat message writes, e.g. CHAT_WRITE_CONCERN_W=1 to trade
+# durability for latency on the hot path while other writes stay on the default.
+CHAT_WRITE_CONCERN = write_concern_from_env("CHAT_WRITE_CONCERN")
+
+# Days a chat message is kept (hot, bucketed or archived) before TTL
+# deletion; 0 keeps messages forever.
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", 0))
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
-if database_url and database_name:
-    _client = MongoClient(database_url)
-    db = _client[database_name]
+# With DB_DRIVER=async the routes use motor (async_database.py) and this
+# client only serves background work, so it does not keep a warm pool.
+ASYNC_DRIVER = os.getenv("DB_DRIVER", "sync").lower() == "async"
+
+# Created on first use by the process that uses it: nothing connects at
+# import time, and a client inherited through fork() (gunicorn preload) is
+# replaced in the child instead of sharing the parent's sockets and threads.
+_client = None
+_db = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> Optional[MongoClient]:
+    """This process's MongoClient; None when DATABASE_URL / DATABASE_NAME are not set"""
+    global _client, _db, _client_pid
+    if not (database_url and database_name):
+        return None
+    if _client_pid != os.getpid():
+        with _client_lock:
+            if _client_pid != os.getpid():
+                if _client is not None:
+                    # Inherited from the parent: drop it without closing the parent's connections
+                    pool_stats.reset()
+                options = client_options()
+                if ASYNC_DRIVER:
+                    options.pop("minPoolSize", None)
+                _client = MongoClient(database_url, **options)
+                _db = _client[database_name]
+                _client_pid = os.getpid()
+    return _client
+
+
+def get_db():
+    """This process's database handle (see get_client); None when not configured"""
+    if _client_pid != os.getpid():
+        get_client()
+    return _db
+
+
+def warm_up(timeout: float = 5.0) -> int:
+    """Connect and pre-open MONGO_MIN_POOL_SIZE connections before serving traffic. Returns open connections."""
+    client = get_client()
+    if client is None:
+        return 0
+    client.admin.command("ping")
+    # The pool fills up to minPoolSize in the background; wait for it
+    target = client.options.pool_options.min_pool_size
+    deadline = time.monotonic() + timeout
+    while pool_stats.open < target and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return pool_stats.open
+
+
+def close_client() -> None:
+    global _client, _db, _client_pid
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = _db = _client_pid = None
+
+def conversation_range_indexes() -> List[IndexModel]:
+    """Indexes for documents holding a (first_at, last_at) range of one conversation's messages"""
+    return [
+        IndexModel([("character_id", ASCENDING), ("last_at", DESCENDING)], name="character_id_last_at"),
+        IndexModel([("character_id", ASCENDING), ("first_at", ASCENDING)], name="character_id_first_at"),
+        IndexModel([("owner", ASCENDING), ("character_id", ASCENDING), ("last_at", DESCENDING)],
+                   name="owner_character_id_last_at"),
+        IndexModel([("owner", ASCENDING), ("character_id", ASCENDING), ("first_at", ASCENDING)],
+                   name="owner_character_id_first_at"),
+    ]
+
+# Index specification: collection name -> indexes the app's queries rely on
+INDEXES = {
+    "message": [
+        # GET/POST /chat/{character_id}/messages: equality on character_id,
+        # keyset sort on (created_at, _id)
+        IndexModel([("character_id", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)],
+                   name="character_id_created_at_id"),
+        # Per-user threads: /users/{username}/chats/{character_id}/messages
+        IndexModel([("owner", ASCENDING), ("character_id", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)],
+                   name="owner_character_id_created_at_id"),
+    ],
+    # MESSAGE_STORAGE=buckets (message_store.py): pages walk buckets by
+    # last_at backwards or first_at forwards; appends match on (owner, character_id)
+    "messagebucket": conversation_range_indexes(),
+    # Archived message chunks (archive.py), paged the same way as buckets
+    "messagearchive": conversation_range_indexes(),
+    "character": [
+        # GET /characters: newest first, keyset on (created_at, _id)
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at_id_desc"),
+    ],
+    "userprofile": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    ],
+    "imagejob": [
+        # Startup recovery of queued jobs whose lease expired
+        IndexModel([("status", ASCENDING), ("leased_until", ASCENDING)], name="status_leased_until"),
+    ],
+    "imageresult": [
+        # Shared image result cache entries expire at expires_at
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "idempotencykey": [
+        # Stored Idempotency-Key responses expire at expires_at
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "ratelimit": [
+        # RATE_LIMIT_BACKEND=mongo: idle token buckets are dropped once full again
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+if MESSAGE_RETENTION_DAYS > 0:
+    # Retention is enforced by MongoDB's TTL monitor; changing the number of
+    # days updates the existing indexes in place (see ensure_indexes).
+    _retention_seconds = MESSAGE_RETENTION_DAYS * 86400
+    INDEXES["message"].append(
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=_retention_seconds))
+    for _collection in ("messagebucket", "messagearchive"):
+        INDEXES[_collection].append(
+            IndexModel([("last_at", ASCENDING)], name="last_at_ttl", expireAfterSeconds=_retention_seconds))
+
+def ensure_indexes(database=None, spec: dict = None) -> dict:
+    """Create any missing indexes from the spec (idempotent). Returns created/updated/failed index names per collection."""
+    database = get_db() if database is None else database
+    if database is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    result = {}
+    for collection_name, indexes in (spec or INDEXES).items():
+        outcome = {"created": [], "updated": [], "failed": {}}
+        try:
+            outcome["created"] = database[collection_name].create_indexes(indexes)
+        except OperationFailure:
+            # Create one at a time so a single conflict (e.g. duplicate usernames
+            # blocking the unique index) does not hold back the others.
+            for index in indexes:
+                name = index.document["name"]
+                try:
+                    outcome["created"].extend(database[collection_name].create_indexes([index]))
+                except OperationFailure as e:
+                    ttl = index.document.get("expireAfterSeconds")
+                    if ttl is not None and e.code == 85:
+                        # IndexOptionsConflict: same TTL index, new expiry
+                        try:
+                            database.command("collMod", collection_name, index={"name": name, "expireAfterSeconds": ttl})
+                            outcome["updated"].append(name)
+                            continue
+                        except OperationFailure as e2:
+                            e = e2
+                    outcome["failed"][name] = str(e)[:200]
+                    logger.error("Could not create index %s.%s: %s", collection_name, name, e)
+        result[collection_name] = outcome
+    return result
+
+def index_report(database=None, spec: dict = None) -> dict:
+    """Compare existing indexes with the spec. Returns missing/extra index names per collection."""
+    database = get_db() if database is None else database
+    if database is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    report = {}
+    for collection_name, indexes in (spec or INDEXES).items():
+        expected = {index.document["name"] for index in indexes}
+        existing = {index["name"] for index in database[collection_name].list_indexes()} - {"_id_"}
+        report[collection_name] = {
+            "missing": sorted(expected - existing),
+            "extra": sorted(existing - expected),
+        }
+    return report
 
 # Helper functions for common database operations
 def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
+    db = get_db()
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
@@ -43,13 +472,74 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     result = db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
+def create_documents(collection_name: str, data_list: List[Union[BaseModel, dict]],
+                     write_concern: Optional[WriteConcern] = None):
+    """Insert several documents in one ordered round-trip.
+
+    Missing created_at/updated_at are filled in. Dicts are inserted as given
+    (not copied), so callers keep the exact documents that were stored.
+    """
+    db = get_db()
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    now = datetime.now(timezone.utc)
+    documents = []
+    for data in data_list:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else data
+        data_dict.setdefault('created_at', now)
+        data_dict.setdefault('updated_at', now)
+        documents.append(data_dict)
+
+    collection = db[collection_name]
+    if write_concern is not None:
+        collection = collection.with_options(write_concern=write_concern)
+    result = collection.insert_many(documents, ordered=True)
+    return [str(inserted_id) for inserted_id in result.inserted_ids]
+
+def update_document(collection_name: str, filter_dict: dict, update_data: dict) -> int:
+    """$set fields (and updated_at) on the first matching document. Returns the modified count."""
+    db = get_db()
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    update = dict(update_data, updated_at=datetime.now(timezone.utc))
+    result = db[collection_name].update_one(filter_dict, {"$set": update})
+    return result.modified_count
+
+def delete_document(collection_name: str, filter_dict: dict) -> int:
+    """Delete the first matching document. Returns the deleted count."""
+    db = get_db()
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    return db[collection_name].delete_one(filter_dict).deleted_count
+
 def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
+    return list(iter_documents(collection_name, filter_dict, limit=limit))
+
+def iter_documents(collection_name: str, filter_dict: dict = None, projection: dict = None,
+                   sort: Sequence[Tuple[str, int]] = None, skip: int = 0, limit: int = None,
+                   batch_size: int = 1000, max_time_ms: int = None) -> Iterator[dict]:
+    """Yield documents lazily, fetching `batch_size` at a time.
+
+    Memory stays bounded by one batch however large the result set. The
+    cursor is closed when the generator is exhausted or closed early.
+    """
+    db = get_db()
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
-    
-    cursor = db[collection_name].find(filter_dict or {})
+
+    cursor = db[collection_name].find(filter_dict or {}, projection, batch_size=batch_size)
+    if sort:
+        cursor = cursor.sort(list(sort))
+    if skip:
+        cursor = cursor.skip(skip)
     if limit:
         cursor = cursor.limit(limit)
-    
-    return list(cursor)
+    if max_time_ms:
+        cursor = cursor.max_time_ms(max_time_ms)
+
+    with cursor:
+        yield from cursor
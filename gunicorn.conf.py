@@ -0,0 +1,39 @@
+"""
+Gunicorn Configuration
+
+Production launch: a gunicorn master supervising uvicorn workers
+(uvloop/httptools when installed via uvicorn[standard]).
+
+    gunicorn -c gunicorn.conf.py main:app
+
+Send HUP to the master (pid in PIDFILE) for a graceful rolling restart,
+TERM to drain and stop.
+"""
+
+import multiprocessing
+import os
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '8000')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+# Async workers: one per core is enough to keep every core busy
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+
+# Recycle each worker after a bounded number of requests (jittered so the
+# workers do not all restart at once) to cap slow memory growth.
+max_requests = int(os.getenv("MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", 1000))
+
+# Seconds a worker gets to finish in-flight requests on restart/shutdown
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+timeout = int(os.getenv("WORKER_TIMEOUT", 60))
+keepalive = int(os.getenv("KEEPALIVE", 5))
+
+# Import the app once in the master and fork workers from it (faster
+# startup, shared memory pages). Safe because MongoDB clients are created
+# lazily per process (database.get_client), never in the master.
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+pidfile = os.getenv("PIDFILE", "logs/server.pid")
+accesslog = os.getenv("ACCESS_LOG") or None
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info")
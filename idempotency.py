@@ -0,0 +1,275 @@
+"""
+Idempotency Keys
+
+ASGI middleware honouring an `Idempotency-Key` header on the POST routes
+that create documents or work (chat turns, image jobs). The first request
+with a key runs normally and its response is stored; retries with the same
+key get that response replayed (with `Idempotent-Replayed: true`) instead
+of creating new messages or jobs.
+
+    same key, request still running      -> 409 + Retry-After
+    same key, different request body     -> 422
+    original response was a 5xx          -> not stored; the retry runs again
+
+Records live in the `idempotencykey` collection (shared by all workers,
+TTL-expired after IDEMPOTENCY_TTL_SECONDS) with an in-process cache of
+completed responses in front. Without a database, the in-process store is
+used alone. Streaming (SSE) routes are not covered.
+
+Response bodies larger than IDEMPOTENCY_MAX_BODY_BYTES (e.g. a `return=full`
+conversation) are not kept: their replay carries the original status with an
+empty body and `Idempotent-Body-Omitted: true`. Clients that need the body
+on a retry should ask for `return=delta`.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from bson.binary import Binary
+from pymongo.errors import DuplicateKeyError
+from starlette.concurrency import run_in_threadpool
+
+import database
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "1") == "1"
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", 86400))
+# How long a claimed key blocks retries before another worker may take it over
+# (covers a worker dying mid-request)
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", 60))
+# Largest response body stored for replay, and memory for the in-process cache of them
+IDEMPOTENCY_MAX_BODY_BYTES = int(os.getenv("IDEMPOTENCY_MAX_BODY_BYTES", 256 * 1024))
+IDEMPOTENCY_CACHE_BYTES = int(os.getenv("IDEMPOTENCY_CACHE_BYTES", 32 * 1024 * 1024))
+IDEMPOTENCY_COLLECTION = "idempotencykey"
+MAX_KEY_LENGTH = 255
+
+# POST routes covered (raw path; the middleware runs before routing)
+IDEMPOTENT_PATHS = [
+    re.compile(r"^/chat/[^/]+/messages$"),
+    re.compile(r"^/users/[^/]+/chats/[^/]+/messages$"),
+    re.compile(r"^/images$"),
+]
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _aware(value: datetime) -> datetime:
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+class IdempotencyStore:
+    """Claim / complete / release of idempotency records, in Mongo when available, else in-process"""
+
+    def __init__(self, ttl: int = IDEMPOTENCY_TTL_SECONDS, lock_seconds: int = IDEMPOTENCY_LOCK_SECONDS,
+                 collection_name: str = IDEMPOTENCY_COLLECTION, maxsize: int = 10000,
+                 max_body_bytes: int = IDEMPOTENCY_MAX_BODY_BYTES, cache_bytes: int = IDEMPOTENCY_CACHE_BYTES):
+        self.ttl = ttl
+        self.lock_seconds = lock_seconds
+        self.collection_name = collection_name
+        self.max_body_bytes = max_body_bytes
+        # Completed responses, so replays skip the database
+        self.completed = TTLCache(maxsize=maxsize, ttl=ttl, max_bytes=cache_bytes)
+        # Claims in flight when running without a database
+        self._local_claims = {}
+        self._lock = threading.Lock()
+
+    def claim(self, record_id: str, fingerprint: str) -> Optional[dict]:
+        """None when the caller now owns the key, otherwise the existing record"""
+        cached = self.completed.get(record_id)
+        if cached is not None:
+            return cached
+        db = database.get_db()
+        now = _now()
+        claim = {
+            "_id": record_id,
+            "status": "in_progress",
+            "fingerprint": fingerprint,
+            "locked_until": now + timedelta(seconds=self.lock_seconds),
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=self.ttl),
+        }
+        if db is None:
+            with self._lock:
+                existing = self._local_claims.get(record_id)
+                if existing is None or _aware(existing["locked_until"]) <= now:
+                    self._local_claims[record_id] = claim
+                    return None
+                return existing
+
+        collection = db[self.collection_name]
+        try:
+            collection.insert_one(claim)
+            return None
+        except DuplicateKeyError:
+            pass
+        existing = collection.find_one({"_id": record_id})
+        if existing is None:
+            return self.claim(record_id, fingerprint)  # expired in between
+        if existing["status"] == "completed":
+            self.completed.set(record_id, existing)
+            return existing
+        if _aware(existing["locked_until"]) <= now:
+            # Abandoned claim: take it over unless another retry got there first
+            taken = collection.replace_one(
+                {"_id": record_id, "status": "in_progress", "locked_until": existing["locked_until"]}, claim)
+            if taken.modified_count:
+                return None
+            return collection.find_one({"_id": record_id}) or existing
+        return existing
+
+    def complete(self, record_id: str, fingerprint: str, status: int, headers: list, body: bytes) -> None:
+        if len(body) > self.max_body_bytes:
+            # Only the outcome is kept; the body's length and type no longer apply
+            headers = [[k, v] for k, v in headers if k.lower() not in ("content-length", "content-type")]
+            body = None
+        record = {
+            "_id": record_id,
+            "status": "completed",
+            "fingerprint": fingerprint,
+            "response_status": status,
+            "response_headers": headers,
+            "response_body": None if body is None else Binary(body),
+            "created_at": _now(),
+            "expires_at": _now() + timedelta(seconds=self.ttl),
+        }
+        self.completed.set(record_id, record)
+        db = database.get_db()
+        if db is None:
+            with self._lock:
+                self._local_claims.pop(record_id, None)
+            return
+        db[self.collection_name].replace_one({"_id": record_id}, record, upsert=True)
+
+    def release(self, record_id: str) -> None:
+        """Forget a claim whose request failed, so a retry runs it again"""
+        db = database.get_db()
+        if db is None:
+            with self._lock:
+                self._local_claims.pop(record_id, None)
+            return
+        db[self.collection_name].delete_one({"_id": record_id, "status": "in_progress"})
+
+
+idempotency_store = IdempotencyStore()
+
+
+async def read_body(receive) -> Optional[bytes]:
+    """Whole request body from an ASGI receive channel; None if the client went away"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def body_receive(body: bytes, receive):
+    """Receive channel that hands an already-read body to the app, then defers to `receive`"""
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return replay
+
+
+async def send_json(send, status: int, detail: str, headers: Optional[list] = None) -> None:
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+                   + (headers or []),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class IdempotencyMiddleware:
+    def __init__(self, app, store: IdempotencyStore = idempotency_store):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        key = None
+        for name, value in scope["headers"]:
+            if name == b"idempotency-key":
+                key = value.decode("latin-1").strip()
+                break
+        if not key or not any(p.match(scope["path"]) for p in IDEMPOTENT_PATHS):
+            await self.app(scope, receive, send)
+            return
+        if len(key) > MAX_KEY_LENGTH:
+            await send_json(send, 400, f"Idempotency-Key longer than {MAX_KEY_LENGTH} characters")
+            return
+
+        # The body is part of the fingerprint, so read it up front and replay it to the app
+        body = await read_body(receive)
+        if body is None:
+            return
+        record_id = f"{scope['path']}|{key}"
+        fingerprint = hashlib.sha256(scope.get("query_string", b"") + b"\0" + body).hexdigest()
+
+        existing = await run_in_threadpool(self.store.claim, record_id, fingerprint)
+        if existing is not None:
+            if existing["fingerprint"] != fingerprint:
+                await send_json(send, 422, "Idempotency-Key was already used with a different request")
+            elif existing["status"] != "completed":
+                await send_json(send, 409, "A request with this Idempotency-Key is still in progress",
+                                 [(b"retry-after", b"1")])
+            else:
+                await self._replay(existing, send)
+            return
+
+        response = {"status": 500, "headers": [], "body": []}
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = [[k.decode("latin-1"), v.decode("latin-1")] for k, v in message.get("headers", [])]
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, body_receive(body, receive), capture_send)
+        except Exception:
+            await run_in_threadpool(self.store.release, record_id)
+            raise
+        if response["status"] >= 500:
+            await run_in_threadpool(self.store.release, record_id)
+            return
+        try:
+            await run_in_threadpool(self.store.complete, record_id, fingerprint, response["status"],
+                                    response["headers"], b"".join(response["body"]))
+        except Exception:
+            # The response is already sent; free the key rather than answer 409 until the lock expires
+            logger.exception("Could not store idempotent response for %s", record_id)
+            await run_in_threadpool(self.store.release, record_id)
+
+    async def _replay(self, record: dict, send) -> None:
+        headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in record["response_headers"]]
+        headers.append((b"idempotent-replayed", b"true"))
+        body = record["response_body"]
+        if body is None:
+            headers += [(b"idempotent-body-omitted", b"true"), (b"content-length", b"0")]
+        await send({"type": "http.response.start", "status": record["response_status"], "headers": headers})
+        await send({"type": "http.response.body", "body": b"" if body is None else bytes(body)})
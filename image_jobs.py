@@ -0,0 +1,196 @@
+"""
+Image Job Pipeline
+
+POST /images persists an `imagejob` document and hands it to ImageJobQueue,
+whose worker pool (threads or processes) runs the configured ImageGenerator
+and records the outcome. Clients poll GET /images/{id} for the result.
+
+Environment:
+    IMAGE_BACKEND          "stub" (default) or "package.module:ClassName"
+    IMAGE_WORKERS          worker pool size (default 4)
+    IMAGE_WORKER_MODE      "thread" (default) or "process"
+    IMAGE_JOB_LEASE_SECONDS  how long a queued job belongs to the process that
+                           accepted it before startup recovery may take it over
+    IMAGE_RESULT_CACHE_SIZE, IMAGE_RESULT_CACHE_TTL
+                           in-memory result cache bounds (entries, seconds)
+    IMAGE_RESULT_CACHE_MONGO  "1" to share results across workers through the
+                           `imageresult` collection
+"""
+
+import importlib
+import logging
+import os
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import database
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class ImageGenerator:
+    """Backend interface: turn a job document into an image URL.
+
+    Implementations must be picklable when IMAGE_WORKER_MODE=process.
+    """
+
+    def generate(self, job: dict) -> str:
+        raise NotImplementedError
+
+
+class StubImageGenerator(ImageGenerator):
+    """Offline backend returning a placeholder image, optionally after a delay"""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+
+    def generate(self, job: dict) -> str:
+        if self.delay:
+            time.sleep(self.delay)
+        seed = job.get("cache_key", "")[:16] or "default"
+        return f"https://picsum.photos/seed/{seed}/768/512"
+
+
+def load_generator(spec: str) -> ImageGenerator:
+    """Instantiate a backend from "stub" or a "module:ClassName" path"""
+    if spec == "stub":
+        return StubImageGenerator(delay=float(os.getenv("IMAGE_STUB_DELAY", 0)))
+    module_name, _, class_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class ImageResultCache:
+    """Generated image URLs by request cache key: in memory, optionally backed by Mongo"""
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 86400.0, use_mongo: bool = False,
+                 collection_name: str = "imageresult"):
+        self.ttl = ttl
+        self.use_mongo = use_mongo
+        self.collection_name = collection_name
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @classmethod
+    def from_env(cls) -> "ImageResultCache":
+        return cls(
+            maxsize=int(os.getenv("IMAGE_RESULT_CACHE_SIZE", 4096)),
+            ttl=float(os.getenv("IMAGE_RESULT_CACHE_TTL", 86400)),
+            use_mongo=os.getenv("IMAGE_RESULT_CACHE_MONGO", "0") == "1",
+        )
+
+    def get_local(self, key: str) -> Optional[str]:
+        return self.memory.get(key)
+
+    def get(self, key: str) -> Optional[str]:
+        url = self.memory.get(key)
+        db = database.get_db()
+        if url is None and self.use_mongo and db is not None:
+            doc = db[self.collection_name].find_one(
+                {"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}}, {"image_url": 1})
+            if doc:
+                url = doc["image_url"]
+                self.memory.set(key, url)
+        return url
+
+    def put(self, key: str, url: str) -> None:
+        self.memory.set(key, url)
+        db = database.get_db()
+        if self.use_mongo and db is not None:
+            now = datetime.now(timezone.utc)
+            db[self.collection_name].update_one(
+                {"_id": key},
+                {"$set": {"image_url": url, "created_at": now, "expires_at": now + timedelta(seconds=self.ttl)}},
+                upsert=True,
+            )
+
+
+image_results = ImageResultCache.from_env()
+
+
+def _generate(generator: ImageGenerator, job: dict) -> str:
+    return generator.generate(job)
+
+
+class ImageJobQueue:
+    def __init__(self, generator: ImageGenerator, workers: int = 4, mode: str = "thread",
+                 lease_seconds: int = 300, collection_name: str = "imagejob"):
+        self.generator = generator
+        self.workers = workers
+        self.mode = mode
+        self.lease_seconds = lease_seconds
+        self.collection_name = collection_name
+        self._executor: Optional[Executor] = None
+
+    @classmethod
+    def from_env(cls) -> "ImageJobQueue":
+        return cls(
+            generator=load_generator(os.getenv("IMAGE_BACKEND", "stub")),
+            workers=int(os.getenv("IMAGE_WORKERS", 4)),
+            mode=os.getenv("IMAGE_WORKER_MODE", "thread"),
+            lease_seconds=int(os.getenv("IMAGE_JOB_LEASE_SECONDS", 300)),
+        )
+
+    @property
+    def collection(self):
+        db = database.get_db()
+        if db is None:
+            raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+        return db[self.collection_name]
+
+    def lease(self) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)
+
+    def start(self) -> None:
+        if self._executor is not None:
+            return
+        if self.mode == "process":
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-job")
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+    def submit(self, job: dict) -> None:
+        """Schedule a persisted, queued job; returns immediately"""
+        self.start()
+        future = self._executor.submit(_generate, self.generator, job)
+        future.add_done_callback(lambda f: self._finish(job, f))
+
+    def _finish(self, job: dict, future: Future) -> None:
+        if future.cancelled():
+            return  # still queued; recovered after its lease expires
+        image_url = None
+        try:
+            image_url = future.result()
+            update = {"status": "completed", "image_url": image_url, "message": "SFW image created"}
+        except Exception as e:
+            logger.exception("Image job %s failed", job["_id"])
+            update = {"status": "failed", "message": f"Generation failed: {str(e)[:200]}"}
+        update["updated_at"] = datetime.now(timezone.utc)
+        try:
+            self.collection.update_one({"_id": job["_id"]}, {"$set": update})
+            if image_url and job.get("cache_key"):
+                image_results.put(job["cache_key"], image_url)
+        except Exception:
+            logger.exception("Could not record result of image job %s", job["_id"])
+
+    def recover(self) -> int:
+        """Resubmit queued jobs whose lease expired (e.g. their process died)"""
+        recovered = 0
+        while True:
+            job = self.collection.find_one_and_update(
+                {"status": "queued", "leased_until": {"$lt": datetime.now(timezone.utc)}},
+                {"$set": {"leased_until": self.lease()}},
+            )
+            if job is None:
+                return recovered
+            self.submit(job)
+            recovered += 1
+
+
+image_jobs = ImageJobQueue.from_env()
@@ -1,259 +1,495 @@
+import logging
 import os
-from datetime import datetime, timezone
-from typing import List, Optional
-from uuid import uuid4
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List, Literal, Optional, Union
 
-from fastapi import FastAPI, HTTPException
+from fastapi import APIRouter, FastAPI, Header, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-
-from database import db
-from schemas import UserProfile, Character, ImageRequest, CharacterOut, MessageOut
-
-app = FastAPI(title="Character Chat + Image App")
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from cache import character_cache, character_list_cache, character_list_flight
+from database import close_client, command_stats, ensure_indexes, get_db, index_report, pool_stats, warm_up
+from idempotency import IDEMPOTENCY_ENABLED, IdempotencyMiddleware
+from image_jobs import image_jobs, image_results
+import archive
+import message_store
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, METRICS_ENABLED, MetricsMiddleware, registry
+from ratelimit import MAX_CONCURRENT_REQUESTS, RATE_LIMIT_ENABLED, AdmissionMiddleware, RateLimitMiddleware
+from rendering import FastJSONResponse, render
+from schemas import BulkUpsertResult, UserProfile, Character, ImageRequest, ImageJobOut, CharacterOut, CharacterPage, MessageOut, MessagePage
+from services import (
+    CHARACTER_LIST_ADAPTER,
+    CHARACTER_PAGE_ADAPTER,
+    CHARACTER_SHAPE,
+    CHARACTER_SORT,
+    BULK_USERS_MAX,
+    DEFAULT_PAGE_SIZE,
+    MESSAGE_LIST_ADAPTER,
+    MESSAGE_PAGE_ADAPTER,
+    NDJSONEncoder,
+    PROFILE_PROJECTION,
+    SSE_HEADERS,
+    ChatIn,
+    ThreadMessageIn,
+    build_character_page,
+    build_turn,
+    character_dict,
+    character_page_query,
+    export_filename,
+    export_query,
+    export_sort,
+    image_job_out,
+    message_dict,
+    ndjson_chunks,
+    new_character_doc,
+    new_character_message,
+    new_image_job,
+    new_user_message,
+    profile_out,
+    profile_upsert,
+    reply_generator,
+    resolve_return_mode,
+    shaped_pipeline,
+    sse_event,
+    wants_page,
+)
 
+logger = logging.getLogger(__name__)
+
+# "sync" serves the routes below through pymongo on the threadpool; "async"
+# serves the async_routes.py equivalents through motor on the event loop.
+DB_DRIVER = os.getenv("DB_DRIVER", "sync").lower()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # This worker's own client, created after any fork
+    db = get_db()
+    if db is not None and os.getenv("MONGO_MIN_POOL_SIZE") and os.getenv("MONGO_WARMUP", "1") == "1":
+        # Open the pool before taking traffic rather than on the first requests
+        try:
+            if DB_DRIVER == "async":
+                import async_database
+                opened = await async_database.warm_up()
+            else:
+                opened = await run_in_threadpool(warm_up)
+            logger.info("MongoDB pool warmed up: %d connections", opened)
+        except Exception as e:
+            logger.error("MongoDB warm-up failed: %s", e)
+    if db is not None and os.getenv("AUTO_CREATE_INDEXES", "1") == "1":
+        try:
+            ensure_indexes()
+            for collection, diff in index_report().items():
+                if diff["missing"] or diff["extra"]:
+                    logger.warning("Index drift on %s: missing=%s extra=%s", collection, diff["missing"], diff["extra"])
+        except Exception as e:
+            logger.error("Index bootstrap failed: %s", e)
+    image_jobs.start()
+    if db is not None:
+        try:
+            recovered = image_jobs.recover()
+            if recovered:
+                logger.info("Resubmitted %d orphaned image jobs", recovered)
+        except Exception as e:
+            logger.error("Image job recovery failed: %s", e)
+        archive.archiver.start()
+    yield
+    archive.archiver.shutdown()
+    image_jobs.shutdown()
+    if DB_DRIVER == "async":
+        import async_database
+        async_database.close_client()
+    close_client()
+
+
+app = FastAPI(title="Character Chat + Image App", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# Middleware added later wraps the ones added before it: requests pass
+# metrics -> CORS -> rate limits -> admission control -> idempotency -> routes.
+if IDEMPOTENCY_ENABLED:
+    app.add_middleware(IdempotencyMiddleware)
+
+if MAX_CONCURRENT_REQUESTS > 0:
+    app.add_middleware(AdmissionMiddleware)
+
+if RATE_LIMIT_ENABLED:
+    app.add_middleware(RateLimitMiddleware)
+
+# Outside the limiters so their 429/503 responses carry CORS headers
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After", "Idempotent-Replayed", "Idempotent-Body-Omitted"],
 )
 
-# Utils
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+router = APIRouter()
+
+
+# Diagnostics (independent of the database driver)
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus text exposition of this worker's metrics"""
+    return Response(registry.expose(), media_type=METRICS_CONTENT_TYPE)
+
 
-def doc_to_str_id(doc: dict) -> dict:
-    d = doc.copy()
-    if "_id" in d:
-        d["id"] = str(d.pop("_id"))
-    return d
+@app.get("/debug/pool")
+def debug_pool():
+    snapshot = pool_stats.snapshot()
+    if DB_DRIVER == "async":
+        import async_database
+        # The routes' pool; the top-level counters are the background client's
+        snapshot["async"] = async_database.pool_stats.snapshot()
+    return snapshot
+
+
+@app.get("/debug/cache")
+def debug_cache():
+    return {"character": character_cache.stats()}
+
+
+@app.get("/debug/slow-commands")
+def debug_slow_commands():
+    """Sampled MongoDB commands slower than SLOW_COMMAND_MS, newest first (literals redacted)"""
+    return {"threshold_ms": command_stats.slow_ms, "commands": command_stats.slow_log()}
 
 
 # Health
-@app.get("/")
+@router.get("/")
 def root():
-    return {"message": "Backend running", "database": bool(db)}
+    return {"message": "Backend running", "database": get_db() is not None}
 
 
-@app.get("/test")
+@router.get("/test")
 def test_database():
+    db = get_db()
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available" if db is None else "✅ Connected",
         "database_url": "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set",
         "database_name": os.getenv("DATABASE_NAME") or None,
-        "collections": []
+        "driver": DB_DRIVER,
+        "collections": [],
+        "indexes": {},
     }
     try:
         if db is not None:
             response["collections"] = db.list_collection_names()[:10]
+            response["indexes"] = index_report()
     except Exception as e:
         response["database"] = f"⚠️ Error: {str(e)[:80]}"
     return response
 
 
 # Users
-@app.post("/users", response_model=UserProfile)
+@router.post("/users", response_model=UserProfile)
 def upsert_user(profile: UserProfile):
+    db = get_db()
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    existing = db["userprofile"].find_one({"username": profile.username})
-    payload = profile.model_dump()
-    payload["updated_at"] = datetime.now(timezone.utc)
-    if existing:
-        db["userprofile"].update_one({"_id": existing["_id"]}, {"$set": payload})
-        doc = db["userprofile"].find_one({"_id": existing["_id"]})
-    else:
-        payload["created_at"] = datetime.now(timezone.utc)
-        payload["_id"] = profile.username  # readable primary key
-        db["userprofile"].insert_one(payload)
-        doc = payload
-    return UserProfile(**{k: doc.get(k) for k in ["username", "age", "trust_score"]})
-
-
-@app.get("/users/{username}", response_model=UserProfile)
+    query, update = profile_upsert(profile)
+    try:
+        doc = db["userprofile"].find_one_and_update(
+            query, update, projection=PROFILE_PROJECTION, upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        # A concurrent request inserted the same username first; update its document
+        doc = db["userprofile"].find_one_and_update(
+            query, update, projection=PROFILE_PROJECTION, return_document=ReturnDocument.AFTER)
+    return profile_out(doc)
+
+
+@router.post("/users/bulk", response_model=BulkUpsertResult)
+def upsert_users_bulk(profiles: List[UserProfile]):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    if len(profiles) > BULK_USERS_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_USERS_MAX} profiles per request")
+    result = BulkUpsertResult(received=len(profiles), matched=0, modified=0, upserted=0)
+    if not profiles:
+        return result
+    ops = [UpdateOne(*profile_upsert(profile), upsert=True) for profile in profiles]
+    try:
+        outcome = (db["userprofile"].bulk_write(ops, ordered=False)).bulk_api_result
+    except BulkWriteError as e:
+        outcome = e.details
+        # Upserts that lost a race with a concurrent insert are retried once
+        retry = [ops[err["index"]] for err in outcome["writeErrors"] if err["code"] == 11000]
+        if len(retry) < len(outcome["writeErrors"]):
+            raise HTTPException(status_code=500, detail=outcome["writeErrors"][0]["errmsg"][:200])
+        retried = (db["userprofile"].bulk_write(retry, ordered=False)).bulk_api_result
+        for key in ("nMatched", "nModified", "nUpserted"):
+            outcome[key] += retried[key]
+    result.matched = outcome["nMatched"]
+    result.modified = outcome["nModified"]
+    result.upserted = outcome["nUpserted"]
+    return result
+
+
+@router.get("/users/{username}", response_model=UserProfile)
 def get_user(username: str):
+    db = get_db()
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
     doc = db["userprofile"].find_one({"username": username})
     if not doc:
         raise HTTPException(status_code=404, detail="User not found")
-    return UserProfile(**{k: doc.get(k) for k in ["username", "age", "trust_score"]})
+    return profile_out(doc)
 
 
 # Characters
-@app.post("/characters", response_model=CharacterOut)
+@router.post("/characters", response_model=CharacterOut)
 def create_character(character: Character):
+    db = get_db()
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    data = character.model_dump()
-    now = datetime.now(timezone.utc)
-    data["created_at"] = now
-    data["updated_at"] = now
-    data["_id"] = str(uuid4())
+    data = new_character_doc(character)
     db["character"].insert_one(data)
-    out = doc_to_str_id(data)
-    return CharacterOut(**{
-        "id": out["id"],
-        "name": out["name"],
-        "personality": out["personality"],
-        "appearance": out.get("appearance"),
-        "location": out.get("location"),
-        "creator_username": out["creator_username"],
-        "nsfw_allowed": out.get("nsfw_allowed", False),
-        "created_at": out["created_at"],
-    })
-
-
-@app.get("/characters", response_model=List[CharacterOut])
-def list_characters():
+    character_cache.set(data["_id"], data)
+    character_list_cache.clear()
+    return character_dict(data)
+
+
+@router.get("/characters", response_model=Union[CharacterPage, List[CharacterOut]])
+def list_characters(
+    limit: Optional[int] = Query(None, ge=1, le=200, description=f"Page size (default {DEFAULT_PAGE_SIZE})"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    x_api_version: int = Header(1),
+):
+    """A CharacterPage for API v2 or when paging; API v1 clients otherwise get every character as a list"""
+    db = get_db()
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    docs = list(db["character"].find().sort("created_at", -1))
-    items: List[CharacterOut] = []
-    for doc in docs:
-        d = doc_to_str_id(doc)
-        items.append(CharacterOut(
-            id=d["id"],
-            name=d["name"],
-            personality=d["personality"],
-            appearance=d.get("appearance"),
-            location=d.get("location"),
-            creator_username=d["creator_username"],
-            nsfw_allowed=d.get("nsfw_allowed", False),
-            created_at=d["created_at"],
-        ))
-    return items
+    paged = wants_page(x_api_version, limit, cursor)
+    limit = limit or DEFAULT_PAGE_SIZE
+    key = (limit, cursor) if paged else None
+    adapter = CHARACTER_PAGE_ADAPTER if paged else CHARACTER_LIST_ADAPTER
+    page = character_list_cache.get(key)
+    if page is not None:
+        return render(page, adapter)
+
+    def load():
+        docs = list(db["character"].aggregate(
+            shaped_pipeline(character_page_query(cursor), CHARACTER_SORT, limit + 1 if paged else None, CHARACTER_SHAPE)))
+        result = build_character_page(docs, limit) if paged else docs
+        character_list_cache.set(key, result)
+        return result
+
+    # Concurrent identical requests share a single query
+    return render(character_list_flight.do(key, load), adapter)
+
+
+def load_character(character_id: str) -> Optional[dict]:
+    """Character document through the shared cache; misses are not cached"""
+    char = character_cache.get(character_id)
+    if char is None:
+        char = get_db()["character"].find_one({"_id": character_id})
+        if char:
+            character_cache.set(character_id, char)
+    return char
 
 
 # Chat messages
-class ChatIn(BaseModel):
-    username: str
-    text: str
-
-
-def generate_character_reply(character: dict, user_text: str) -> str:
-    persona = character.get("personality", "kind and helpful")
-    name = character.get("name", "Your character")
-    prompt_safe = user_text[:400]
-    reply = (
-        f"{name}: As a {persona} character, I hear you say: '{prompt_safe}'. "
-        "Here's my friendly response: I'm excited to chat and co-create images. "
-        "Share more about style, mood, and setting!"
-    )
-    return reply
+@router.post("/chat/{character_id}/messages", response_model=List[MessageOut])
+def post_message(
+    character_id: str,
+    payload: ChatIn,
+    return_mode: Optional[Literal["delta", "full"]] = Query(None, alias="return"),
+    x_api_version: int = Header(1),
+):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    char = load_character(character_id)
+    if not char:
+        raise HTTPException(status_code=404, detail="Character not found")
+
+    user_msg, char_msg = build_turn(char, character_id, payload)
+    # Both messages in one round-trip; ordered so the reply never lands without the user message
+    message_store.append([user_msg, char_msg])
+
+    if resolve_return_mode(return_mode, x_api_version) == "delta":
+        msgs = [message_dict(user_msg), message_dict(char_msg)]
+    else:
+        msgs = message_store.history({"character_id": character_id})
+    return render(msgs, MESSAGE_LIST_ADAPTER)
 
 
-@app.post("/chat/{character_id}/messages", response_model=List[MessageOut])
-def post_message(character_id: str, payload: ChatIn):
+@router.post("/chat/{character_id}/messages/stream")
+def stream_message(character_id: str, payload: ChatIn):
+    """Server-Sent Events: `message` (stored user message), `token`* (reply chunks), then `done` (stored reply)"""
+    db = get_db()
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    char = db["character"].find_one({"_id": character_id})
+    char = load_character(character_id)
     if not char:
         raise HTTPException(status_code=404, detail="Character not found")
 
-    now = datetime.now(timezone.utc)
-    # Store user message
-    user_msg = {
-        "_id": str(uuid4()),
-        "character_id": character_id,
-        "username": payload.username,
-        "text": payload.text,
-        "role": "user",
-        "created_at": now,
-        "updated_at": now,
-    }
-    db["message"].insert_one(user_msg)
-
-    # Store character reply (simple safe generator)
-    reply_text = generate_character_reply(char, payload.text)
-    char_msg = {
-        "_id": str(uuid4()),
-        "character_id": character_id,
-        "username": char.get("name", "character"),
-        "text": reply_text,
-        "role": "character",
-        "created_at": now,
-        "updated_at": now,
-    }
-    db["message"].insert_one(char_msg)
-
-    msgs = list(db["message"].find({"character_id": character_id}).sort("created_at", 1))
-    out: List[MessageOut] = []
-    for m in msgs:
-        d = doc_to_str_id(m)
-        out.append(MessageOut(
-            id=d["id"],
-            character_id=d["character_id"],
-            username=d["username"],
-            text=d["text"],
-            role=d["role"],
-            created_at=d["created_at"],
-        ))
-    return out
-
-
-@app.get("/chat/{character_id}/messages", response_model=List[MessageOut])
-def get_messages(character_id: str):
+    user_msg = new_user_message(character_id, payload)
+    message_store.append([user_msg])
+
+    def events():
+        yield sse_event("message", message_dict(user_msg))
+        chunks = []
+        try:
+            for chunk in reply_generator.stream(char, payload.text):
+                chunks.append(chunk)
+                yield sse_event("token", {"text": chunk})
+        except Exception as e:
+            yield sse_event("error", {"detail": str(e)[:200]})
+            return
+        # Persisted only once the reply is complete
+        char_msg = new_character_message(char, character_id, "".join(chunks), user_msg)
+        message_store.append([char_msg])
+        yield sse_event("done", message_dict(char_msg))
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@router.get("/chat/{character_id}/messages", response_model=Union[MessagePage, List[MessageOut]])
+def get_messages(
+    character_id: str,
+    limit: Optional[int] = Query(None, ge=1, le=500, description=f"Page size (default {DEFAULT_PAGE_SIZE})"),
+    before: Optional[str] = Query(None, description="Cursor: return messages older than this position"),
+    after: Optional[str] = Query(None, description="Cursor: return messages newer than this position"),
+    x_api_version: int = Header(1),
+):
+    """A MessagePage for API v2 or when paging; API v1 clients otherwise get the whole conversation as a list"""
+    db = get_db()
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    msgs = list(db["message"].find({"character_id": character_id}).sort("created_at", 1))
-    out: List[MessageOut] = []
-    for m in msgs:
-        d = doc_to_str_id(m)
-        out.append(MessageOut(
-            id=d["id"],
-            character_id=d["character_id"],
-            username=d["username"],
-            text=d["text"],
-            role=d["role"],
-            created_at=d["created_at"],
-        ))
-    return out
-
-
-# Image generation (demo: SFW placeholder, NSFW gated and blocked in this demo)
-class ImageGenResponse(BaseModel):
-    id: str
-    status: str
-    message: str
-    image_url: Optional[str] = None
-
-
-@app.post("/images", response_model=ImageGenResponse)
-def generate_image(req: ImageRequest):
+    if not wants_page(x_api_version, limit, before, after):
+        return render(message_store.history({"character_id": character_id}), MESSAGE_LIST_ADAPTER)
+    page = message_store.page({"character_id": character_id}, limit or DEFAULT_PAGE_SIZE, before, after)
+    return render(page, MESSAGE_PAGE_ADAPTER)
+
+
+# Per-user conversation threads: only this user's turns with the character
+@router.post("/users/{username}/chats/{character_id}/messages", response_model=List[MessageOut])
+def post_thread_message(username: str, character_id: str, payload: ThreadMessageIn):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    char = load_character(character_id)
+    if not char:
+        raise HTTPException(status_code=404, detail="Character not found")
+
+    user_msg, char_msg = build_turn(char, character_id, ChatIn(username=username, text=payload.text))
+    message_store.append([user_msg, char_msg])
+    return render([message_dict(user_msg), message_dict(char_msg)], MESSAGE_LIST_ADAPTER)
+
+
+@router.get("/users/{username}/chats/{character_id}/messages", response_model=MessagePage)
+def get_thread_messages(
+    username: str,
+    character_id: str,
+    limit: int = Query(50, ge=1, le=500),
+    before: Optional[str] = Query(None, description="Cursor: return messages older than this position"),
+    after: Optional[str] = Query(None, description="Cursor: return messages newer than this position"),
+):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    page = message_store.page(message_store.conversation_filter(character_id, owner=username), limit, before, after)
+    return render(page, MESSAGE_PAGE_ADAPTER)
+
+
+# Export
+@router.get("/export/messages")
+def export_messages(
+    character_id: Optional[str] = None,
+    username: Optional[str] = Query(None, description="Sender of the message"),
+    owner: Optional[str] = Query(None, description="User whose conversation threads to export"),
+    since: Optional[datetime] = Query(None, description="Only messages created at or after this time"),
+    until: Optional[datetime] = Query(None, description="Only messages created before this time"),
+    gzip: bool = Query(False, description="Compress the stream with gzip"),
+    batch_size: int = Query(1000, ge=1, le=10000),
+):
+    """Stream matching messages as NDJSON straight from the cursor, in constant memory"""
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    docs = message_store.export(
+        export_query(character_id, username, since, until, owner),
+        sort=export_sort(character_id),
+        batch_size=batch_size,
+    )
+    encoder = NDJSONEncoder(compress=gzip)
+    return StreamingResponse(ndjson_chunks(docs, encoder), media_type=encoder.media_type, headers=export_filename(gzip))
+
+
+# Archived (cold) messages, read-only
+@router.get("/archive/chat/{character_id}/messages", response_model=MessagePage)
+def get_archived_messages(
+    character_id: str,
+    owner: Optional[str] = Query(None, description="Only this user's conversation thread"),
+    limit: int = Query(50, ge=1, le=500),
+    before: Optional[str] = Query(None, description="Cursor: return messages older than this position"),
+    after: Optional[str] = Query(None, description="Cursor: return messages newer than this position"),
+):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    page = archive.page(message_store.conversation_filter(character_id, owner=owner), limit, before, after)
+    return render(page, MESSAGE_PAGE_ADAPTER)
+
+
+# Image generation: jobs are persisted and rendered by the image_jobs worker pool
+@router.post("/images", response_model=ImageJobOut, status_code=202)
+def generate_image(req: ImageRequest, response: Response):
+    db = get_db()
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
 
     # Fetch character and user
-    char = db["character"].find_one({"_id": req.character_id})
+    char = load_character(req.character_id)
     if not char:
         raise HTTPException(status_code=404, detail="Character not found")
     user = db["userprofile"].find_one({"username": req.username})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if req.rating == "NSFW":
-        return ImageGenResponse(
-            id=str(uuid4()),
-            status="blocked",
-            message=(
-                "NSFW image generation is gated and disabled in this demo. "
-                "Earn trust and ensure adult age in a production-ready system."
-            ),
-            image_url=None,
-        )
-
-    desc = f"{char.get('name')} | {char.get('personality')} | {char.get('appearance') or ''} | {char.get('location') or ''} | {req.prompt}"
-    seed = abs(hash(desc)) % 1000
-    placeholder_url = f"https://picsum.photos/seed/{seed}/768/512"
-
-    return ImageGenResponse(
-        id=str(uuid4()),
-        status="completed",
-        message="SFW image created (placeholder)",
-        image_url=placeholder_url,
-    )
+    job = new_image_job(char, req)
+    if job["status"] == "queued":
+        # Identical requests reuse the earlier result instead of regenerating
+        cached_url = image_results.get(job["cache_key"])
+        if cached_url:
+            job.update(status="completed", image_url=cached_url, message="SFW image created (cached)")
+        else:
+            job["leased_until"] = image_jobs.lease()
+    db["imagejob"].insert_one(job)
+    if job["status"] == "queued":
+        image_jobs.submit(job)
+    else:
+        response.status_code = 200  # cached or blocked: nothing left to do
+    return image_job_out(job)
+
+
+@router.get("/images/{job_id}", response_model=ImageJobOut)
+def get_image_job(job_id: str):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    job = db["imagejob"].find_one({"_id": job_id})
+    if not job:
+        raise HTTPException(status_code=404, detail="Image job not found")
+    return image_job_out(job)
+
+
+if DB_DRIVER == "async":
+    from async_routes import router as async_router
+    app.include_router(async_router)
+else:
+    app.include_router(router)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,345 @@
+"""
+Message Storage
+
+Reads and writes of chat messages for the routes, in one of two layouts
+chosen with MESSAGE_STORAGE:
+
+    documents  one document per message in `message` (default)
+    buckets    messages appended to per-conversation documents in
+               `messagebucket`, at most MESSAGE_BUCKET_SIZE per bucket:
+               {_id, character_id, owner, count, first_at, last_at, messages: [...]}
+
+A conversation is a (character_id, owner) pair. Bucket reads fetch whole
+buckets newest (or oldest) first and stop as soon as the page is complete,
+so a page costs a handful of bucket reads instead of one read per message.
+
+Migrate existing messages into buckets with:
+
+    python message_store.py migrate [--delete]
+"""
+
+import os
+import sys
+from datetime import timezone
+from typing import Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+import database
+from database import CHAT_WRITE_CONCERN, create_documents, iter_documents
+from services import (
+    HISTORY_SORT,
+    MESSAGE_SHAPE,
+    build_message_page,
+    decode_cursor,
+    message_dict,
+    message_page_query,
+    shaped_pipeline,
+)
+
+MESSAGE_STORAGE = os.getenv("MESSAGE_STORAGE", "documents").lower()
+BUCKET_SIZE = int(os.getenv("MESSAGE_BUCKET_SIZE", 200))
+BUCKET_COLLECTION = "messagebucket"
+
+# Buckets fetched per round-trip while paging
+BUCKET_BATCH_SIZE = 4
+
+
+def use_buckets() -> bool:
+    return MESSAGE_STORAGE == "buckets"
+
+
+def conversation_filter(character_id: str, owner: Optional[str] = None) -> dict:
+    return {"character_id": character_id} if owner is None else {"owner": owner, "character_id": character_id}
+
+
+def _key(doc: dict) -> tuple:
+    created_at = doc["created_at"]
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at, str(doc["_id"])
+
+
+# Bucket layout helpers
+
+def bucket_append_update(docs: List[dict]) -> Tuple[dict, dict]:
+    """Filter/update appending one conversation's messages to a bucket with room, or upserting a new one"""
+    first = docs[0]
+    query = {
+        "character_id": first["character_id"],
+        "owner": first.get("owner"),
+        # Size guard: only buckets that can take the whole batch
+        "count": {"$lte": BUCKET_SIZE - len(docs)},
+    }
+    update = {
+        "$push": {"messages": {"$each": docs}},
+        "$inc": {"count": len(docs)},
+        "$min": {"first_at": min(d["created_at"] for d in docs)},
+        "$max": {"last_at": max(d["created_at"] for d in docs)},
+        "$setOnInsert": {"_id": str(uuid4())},
+    }
+    return query, update
+
+
+def bucket_page_query(base: dict, before: Optional[str], after: Optional[str]) -> Tuple[dict, list, int, tuple, tuple]:
+    """Bucket filter and order for a page, plus the decoded (created_at, _id) cursor bounds"""
+    upper = decode_cursor(before) if before else None
+    lower = decode_cursor(after) if after else None
+    query = dict(base)
+    if upper:
+        query["first_at"] = {"$lte": upper[0]}
+    if lower:
+        query["last_at"] = {"$gte": lower[0]}
+    # Same traversal as the documents layout: forward from `after`, otherwise newest first
+    direction = 1 if after and not before else -1
+    sort = [("last_at", -1)] if direction == -1 else [("first_at", 1)]
+    return query, sort, direction, lower, upper
+
+
+class BucketPager:
+    """Collects the limit + 1 messages nearest the cursor from buckets fed in traversal order"""
+
+    def __init__(self, limit: int, direction: int, lower: Optional[tuple], upper: Optional[tuple]):
+        self.limit = limit
+        self.direction = direction
+        self.lower = lower
+        self.upper = upper
+        self.items = []
+
+    def feed(self, bucket: dict) -> bool:
+        """Add a bucket's matching messages; returns False once later buckets cannot contribute"""
+        if len(self.items) > self.limit:
+            # Buckets arrive by last_at desc (or first_at asc), so once a bucket
+            # lies entirely beyond the furthest kept message, the rest do too.
+            edge = self.items[-1]["created_at"].replace(tzinfo=None)
+            if self.direction == -1 and bucket["last_at"].replace(tzinfo=None) < edge:
+                return False
+            if self.direction == 1 and bucket["first_at"].replace(tzinfo=None) > edge:
+                return False
+        for msg in bucket.get("messages", []):
+            key = _key(msg)
+            if (self.upper and key >= self.upper) or (self.lower and key <= self.lower):
+                continue
+            self.items.append(msg)
+        self.items.sort(key=_key, reverse=self.direction == -1)
+        del self.items[self.limit + 1:]
+        return True
+
+
+def bucket_history_pipeline(base: dict, query: Optional[dict] = None, sort: Optional[list] = None,
+                            shape: Optional[dict] = MESSAGE_SHAPE) -> List[dict]:
+    """Unwind the conversation's buckets back into messages"""
+    pipeline = [
+        {"$match": base},
+        {"$unwind": "$messages"},
+        {"$replaceRoot": {"newRoot": "$messages"}},
+    ]
+    if query:
+        pipeline.append({"$match": query})
+    if sort:
+        pipeline.append({"$sort": dict(sort)})
+    if shape:
+        pipeline.append(shape)
+    return pipeline
+
+
+def bucket_export_filter(query: dict) -> dict:
+    """Bucket-level part of an export query: conversation keys and time-range pruning"""
+    base = {k: query[k] for k in ("character_id", "owner") if k in query}
+    created_at = query.get("created_at", {})
+    if "$gte" in created_at:
+        base["last_at"] = {"$gte": created_at["$gte"]}
+    if "$lt" in created_at:
+        base["first_at"] = {"$lt": created_at["$lt"]}
+    return base
+
+
+def _messages_collection(db, name: str = "message"):
+    collection = db[name]
+    if CHAT_WRITE_CONCERN is not None:
+        collection = collection.with_options(write_concern=CHAT_WRITE_CONCERN)
+    return collection
+
+
+# Sync access (pymongo)
+
+def append(docs: List[dict]) -> None:
+    """Persist messages of one conversation in a single round-trip"""
+    if use_buckets():
+        _messages_collection(database.get_db(), BUCKET_COLLECTION).update_one(*bucket_append_update(docs), upsert=True)
+    else:
+        create_documents("message", docs, write_concern=CHAT_WRITE_CONCERN)
+
+
+def page(base: dict, limit: int, before: Optional[str], after: Optional[str]) -> dict:
+    """One keyset page (MessagePage content) of a conversation"""
+    db = database.get_db()
+    if not use_buckets():
+        query, direction = message_page_query(base["character_id"], before, after, owner=base.get("owner"))
+        msgs = list(db["message"].aggregate(
+            shaped_pipeline(query, [("created_at", direction), ("_id", direction)], limit + 1, MESSAGE_SHAPE)))
+        return build_message_page(msgs, limit, direction, before, after)
+
+    query, sort, direction, lower, upper = bucket_page_query(base, before, after)
+    pager = BucketPager(limit, direction, lower, upper)
+    with db[BUCKET_COLLECTION].find(query, sort=sort, batch_size=BUCKET_BATCH_SIZE) as cursor:
+        for bucket in cursor:
+            if not pager.feed(bucket):
+                break
+    return build_message_page([message_dict(m) for m in pager.items], limit, direction, before, after)
+
+
+def history(base: dict) -> List[dict]:
+    """The whole conversation, shaped and in chronological order"""
+    db = database.get_db()
+    if use_buckets():
+        return list(db[BUCKET_COLLECTION].aggregate(bucket_history_pipeline(base, sort=HISTORY_SORT), allowDiskUse=True))
+    return list(db["message"].aggregate(shaped_pipeline(base, HISTORY_SORT, None, MESSAGE_SHAPE)))
+
+
+def export(query: dict, sort: Optional[list], batch_size: int) -> Iterator[dict]:
+    """Lazily iterate raw message documents matching an export query"""
+    if not use_buckets():
+        yield from iter_documents("message", query, sort=sort, batch_size=batch_size)
+        return
+    pipeline = bucket_history_pipeline(bucket_export_filter(query), query, sort, shape=None)
+    with database.get_db()[BUCKET_COLLECTION].aggregate(pipeline, allowDiskUse=True, batchSize=batch_size) as cursor:
+        yield from cursor
+
+
+# Async access (motor)
+
+async def aappend(docs: List[dict]) -> None:
+    import async_database
+    if use_buckets():
+        await _messages_collection(async_database.get_db(), BUCKET_COLLECTION).update_one(*bucket_append_update(docs), upsert=True)
+    else:
+        await async_database.create_documents("message", docs, write_concern=CHAT_WRITE_CONCERN)
+
+
+async def apage(base: dict, limit: int, before: Optional[str], after: Optional[str]) -> dict:
+    import async_database
+    db = async_database.get_db()
+    if not use_buckets():
+        query, direction = message_page_query(base["character_id"], before, after, owner=base.get("owner"))
+        msgs = await db["message"].aggregate(
+            shaped_pipeline(query, [("created_at", direction), ("_id", direction)], limit + 1, MESSAGE_SHAPE)
+        ).to_list(length=None)
+        return build_message_page(msgs, limit, direction, before, after)
+
+    query, sort, direction, lower, upper = bucket_page_query(base, before, after)
+    pager = BucketPager(limit, direction, lower, upper)
+    cursor = db[BUCKET_COLLECTION].find(query, sort=sort, batch_size=BUCKET_BATCH_SIZE)
+    try:
+        async for bucket in cursor:
+            if not pager.feed(bucket):
+                break
+    finally:
+        await cursor.close()
+    return build_message_page([message_dict(m) for m in pager.items], limit, direction, before, after)
+
+
+async def ahistory(base: dict) -> List[dict]:
+    import async_database
+    db = async_database.get_db()
+    if use_buckets():
+        return await db[BUCKET_COLLECTION].aggregate(
+            bucket_history_pipeline(base, sort=HISTORY_SORT), allowDiskUse=True).to_list(length=None)
+    return await db["message"].aggregate(shaped_pipeline(base, HISTORY_SORT, None, MESSAGE_SHAPE)).to_list(length=None)
+
+
+async def aexport(query: dict, sort: Optional[list], batch_size: int):
+    import async_database
+    if not use_buckets():
+        async for doc in async_database.aiter_documents("message", query, sort=sort, batch_size=batch_size):
+            yield doc
+        return
+    pipeline = bucket_history_pipeline(bucket_export_filter(query), query, sort, shape=None)
+    cursor = async_database.get_db()[BUCKET_COLLECTION].aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+    try:
+        async for doc in cursor:
+            yield doc
+    finally:
+        await cursor.close()
+
+
+# Migration
+
+def migrate_to_buckets(delete: bool = False, batch_size: int = 1000) -> dict:
+    """Copy `message` documents into buckets, one conversation at a time.
+
+    Buckets are keyed by their first message's _id, so an interrupted run can
+    simply be restarted: buckets already written are skipped, or extended with
+    messages that arrived since. With delete=True the migrated documents are
+    removed from `message` afterwards, but only once a bucket holds them.
+    """
+    from pymongo.errors import DuplicateKeyError
+
+    db = database.get_db()
+    stats = {"messages": 0, "buckets": 0, "extended": 0, "skipped": 0, "deleted": 0}
+
+    def store(batch: List[dict]) -> List[str]:
+        """Write a batch into buckets; returns the _ids now held by a bucket"""
+        first = batch[0]
+        bucket = {
+            "_id": f"migrated-{first['_id']}",
+            "character_id": first["character_id"],
+            "owner": first.get("owner"),
+            "count": len(batch),
+            "first_at": batch[0]["created_at"],
+            "last_at": batch[-1]["created_at"],
+            "messages": batch,
+        }
+        try:
+            db[BUCKET_COLLECTION].insert_one(bucket)
+            stats["buckets"] += 1
+            return [m["_id"] for m in batch]
+        except DuplicateKeyError:
+            pass
+        # Written by an earlier run, possibly before newer messages of the conversation arrived
+        existing = db[BUCKET_COLLECTION].find_one({"_id": bucket["_id"]}, {"messages._id": 1}) or {}
+        held = {m["_id"] for m in existing.get("messages", [])}
+        missing = [m for m in batch if m["_id"] not in held]
+        if not missing:
+            stats["skipped"] += 1
+            return [m["_id"] for m in batch]
+        extended = db[BUCKET_COLLECTION].update_one(
+            {"_id": bucket["_id"], "count": {"$lte": BUCKET_SIZE - len(missing)}},
+            {
+                "$push": {"messages": {"$each": missing}},
+                "$inc": {"count": len(missing)},
+                "$min": {"first_at": missing[0]["created_at"]},
+                "$max": {"last_at": missing[-1]["created_at"]},
+            },
+        )
+        if extended.modified_count:
+            stats["extended"] += 1
+            return [m["_id"] for m in batch]
+        # No room left (or the bucket is gone): the rest starts a bucket of its own
+        return [m["_id"] for m in batch if m["_id"] in held] + store(missing)
+
+    def flush(batch: List[dict]) -> None:
+        stored = store(batch)
+        if delete and stored:
+            stats["deleted"] += db["message"].delete_many({"_id": {"$in": stored}}).deleted_count
+
+    # Walks the (owner, character_id, created_at, _id) index, one conversation after another
+    order = [("owner", 1), ("character_id", 1)] + HISTORY_SORT
+    batch, conversation = [], None
+    for doc in iter_documents("message", sort=order, batch_size=batch_size):
+        doc.pop("updated_at", None)
+        key = (doc.get("owner"), doc["character_id"])
+        if batch and (key != conversation or len(batch) >= BUCKET_SIZE):
+            flush(batch)
+            batch = []
+        conversation = key
+        batch.append(doc)
+        stats["messages"] += 1
+    if batch:
+        flush(batch)
+    return stats
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["migrate"]:
+        sys.exit("usage: python message_store.py migrate [--delete]")
+    print(migrate_to_buckets(delete="--delete" in sys.argv[2:]))
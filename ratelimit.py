@@ -0,0 +1,280 @@
+"""
+Rate Limiting and Admission Control
+
+Two ASGI middlewares:
+
+RateLimitMiddleware   token buckets per user and per client IP.
+                      Over the limit -> 429 with Retry-After.
+AdmissionMiddleware   caps requests served at once per process; up to
+                      MAX_QUEUED_REQUESTS more wait (at most
+                      QUEUE_TIMEOUT_SECONDS) for a slot, anything beyond
+                      -> 503 with Retry-After, so overload sheds load
+                      instead of growing latency without bound.
+
+The API has no authentication, so a username from a
+/users/{username}/chats/... path or the JSON body's "username" is whatever
+the client sent. Its bucket is therefore keyed by (client IP, username):
+nobody can drain another user's bucket from elsewhere, and rotating names
+stays under the IP limit. Other requests (e.g. POST /users/bulk) only count
+against the IP limit.
+Behind a gateway that authenticates users, set RATE_LIMIT_USER_HEADER to the
+header carrying the verified identity; that header alone keys user buckets.
+
+Buckets live in process memory by default (RATE_LIMIT_BACKEND=memory),
+which limits per worker. RATE_LIMIT_BACKEND=mongo shares them across
+workers and hosts through the `ratelimit` collection; any other value is a
+"module:ClassName" implementing RateLimitBackend.
+"""
+
+import asyncio
+import importlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from pymongo import ReturnDocument
+from starlette.concurrency import run_in_threadpool
+
+import database
+from idempotency import body_receive, read_body, send_json
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+# Sustained rate per minute and burst size (bucket capacity); 0 disables that limit
+USER_PER_MINUTE = float(os.getenv("RATE_LIMIT_USER_PER_MINUTE", 60))
+USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", 20))
+IP_PER_MINUTE = float(os.getenv("RATE_LIMIT_IP_PER_MINUTE", 600))
+IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", 100))
+# Take the client IP from X-Forwarded-For (only behind a trusted proxy)
+TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "0") == "1"
+# Header set by a trusted, authenticating proxy with the verified user
+USER_HEADER = os.getenv("RATE_LIMIT_USER_HEADER", "").lower().encode("latin-1")
+
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", 0))
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", 100))
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("QUEUE_TIMEOUT_SECONDS", 5))
+
+# Monitoring must keep working under load
+EXEMPT_PATHS = re.compile(r"^/(metrics|debug/|$)")
+# Only the per-user chat routes carry a username; /users/bulk is not one
+USER_PATH = re.compile(r"^/users/([^/]+)/chats/")
+# Bodies larger than this are not parsed for a username
+MAX_BODY_SNIFF = 64 * 1024
+
+rejected_requests = registry.counter(
+    "rejected_requests_total", "Requests refused by rate limiting or admission control", ("reason",))
+
+
+class RateLimitBackend:
+    """Token bucket storage. take() returns (allowed, seconds until a token is available)."""
+
+    def take(self, key: str, rate: float, capacity: float, cost: float = 1.0) -> Tuple[bool, float]:
+        raise NotImplementedError
+
+    # Whether take() does I/O and should run off the event loop
+    blocking = False
+
+
+class MemoryBackend(RateLimitBackend):
+    """Per-process buckets, least recently used ones dropped beyond `maxsize` (a dropped bucket is full)"""
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, capacity: float, cost: float = 1.0) -> Tuple[bool, float]:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (cost - tokens) / rate
+
+
+class MongoBackend(RateLimitBackend):
+    """Buckets shared by all workers: one atomic pipeline update per request"""
+
+    blocking = True
+
+    def __init__(self, collection_name: str = "ratelimit"):
+        self.collection_name = collection_name
+
+    def take(self, key: str, rate: float, capacity: float, cost: float = 1.0) -> Tuple[bool, float]:
+        db = database.get_db()
+        if db is None:
+            raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+        now = datetime.now(timezone.utc)
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        refilled = {"$min": [capacity, {"$add": [{"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed, rate]}]}]}
+        doc = db[self.collection_name].find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "updated_at": now}},
+                {"$set": {"allowed": {"$gte": ["$tokens", cost]}}},
+                {"$set": {
+                    "tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", cost]}, "$tokens"]},
+                    # An idle bucket is full again after capacity / rate seconds; drop it then
+                    "expires_at": now + timedelta(seconds=capacity / rate),
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc["allowed"]:
+            return True, 0.0
+        return False, (cost - doc["tokens"]) / rate
+
+
+def load_backend(spec: str) -> RateLimitBackend:
+    """Instantiate a backend from "memory", "mongo" or a "module:ClassName" path"""
+    if spec == "memory":
+        return MemoryBackend()
+    if spec == "mongo":
+        return MongoBackend()
+    module_name, _, class_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+rate_limit_backend = load_backend(os.getenv("RATE_LIMIT_BACKEND", "memory"))
+
+
+def client_ip(scope: dict) -> str:
+    if TRUST_FORWARDED:
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "-"
+
+
+def trusted_user(scope: dict) -> Optional[str]:
+    if not USER_HEADER:
+        return None
+    for name, value in scope["headers"]:
+        if name == USER_HEADER:
+            return value.decode("latin-1").strip() or None
+    return None
+
+
+def body_username(scope: dict, body: bytes) -> Optional[str]:
+    content_type = dict(scope["headers"]).get(b"content-type", b"")
+    if not body or len(body) > MAX_BODY_SNIFF or not content_type.startswith(b"application/json"):
+        return None
+    try:
+        username = json.loads(body).get("username")
+    except (ValueError, AttributeError):
+        return None
+    return username if isinstance(username, str) else None
+
+
+def _retry_after(seconds: float) -> list:
+    return [(b"retry-after", str(max(1, math.ceil(seconds))).encode())]
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, backend: RateLimitBackend = None):
+        self.app = app
+        self.backend = backend or rate_limit_backend
+
+    async def _take(self, key: str, rate: float, capacity: float) -> Tuple[bool, float]:
+        try:
+            if self.backend.blocking:
+                return await run_in_threadpool(self.backend.take, key, rate, capacity)
+            return self.backend.take(key, rate, capacity)
+        except Exception as e:
+            # A broken shared backend must not take the API down with it
+            logger.warning("Rate limit backend failed, allowing request: %s", e)
+            return True, 0.0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or EXEMPT_PATHS.match(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        ip = client_ip(scope)
+        if IP_PER_MINUTE > 0:
+            allowed, wait = await self._take(f"ip:{ip}", IP_PER_MINUTE / 60, IP_BURST)
+            if not allowed:
+                rejected_requests.inc("ip")
+                await send_json(send, 429, "Too many requests from this address", _retry_after(wait))
+                return
+
+        if USER_PER_MINUTE > 0:
+            user_key = None
+            user = trusted_user(scope)
+            if user:
+                user_key = f"user:{user}"
+            else:
+                # Client-chosen name: only ever shares a bucket with the same address
+                match = USER_PATH.match(scope["path"])
+                username = match.group(1) if match else None
+                if username is None and scope["method"] == "POST":
+                    body = await read_body(receive)
+                    if body is None:
+                        return
+                    receive = body_receive(body, receive)
+                    username = body_username(scope, body)
+                if username:
+                    user_key = f"ipuser:{ip}:{username}"
+            if user_key:
+                allowed, wait = await self._take(user_key, USER_PER_MINUTE / 60, USER_BURST)
+                if not allowed:
+                    rejected_requests.inc("user")
+                    await send_json(send, 429, "Too many requests for this user", _retry_after(wait))
+                    return
+
+        await self.app(scope, receive, send)
+
+
+class AdmissionMiddleware:
+    """Bounded concurrency with a bounded, time-limited wait queue (per process)"""
+
+    def __init__(self, app, limit: int = MAX_CONCURRENT_REQUESTS, queue: int = MAX_QUEUED_REQUESTS,
+                 timeout: float = QUEUE_TIMEOUT_SECONDS):
+        self.app = app
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(limit)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or EXEMPT_PATHS.match(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        if self._slots.locked():
+            if self.waiting >= self.queue:
+                rejected_requests.inc("overloaded")
+                await send_json(send, 503, "Server is overloaded, retry later", _retry_after(self.timeout))
+                return
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                rejected_requests.inc("queue_timeout")
+                await send_json(send, 503, "Server is overloaded, retry later", _retry_after(self.timeout))
+                return
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self._slots.release()
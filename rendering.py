@@ -0,0 +1,61 @@
+"""
+Response Rendering
+
+JSON rendering for the API. FastJSONResponse is the app's default response
+class (orjson when installed). In the fast render mode, list endpoints hand
+plain dicts built straight from database documents to it, skipping the
+per-item Pydantic models, response_model re-validation and jsonable_encoder.
+Output is byte-identical to the Pydantic path.
+
+Environment:
+    RENDER_MODE      "fast" (default) or "pydantic" (classic response_model path)
+    RENDER_VALIDATE  "1" to still validate fast-path payloads with TypeAdapter
+"""
+
+import json
+import os
+from datetime import datetime
+from typing import Any, Optional
+
+from pydantic import TypeAdapter
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # stdlib fallback producing the same bytes, only slower
+    orjson = None
+
+FAST_RENDER = os.getenv("RENDER_MODE", "fast").lower() == "fast"
+RENDER_VALIDATE = os.getenv("RENDER_VALIDATE", "0") == "1"
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        # Same format as Pydantic's JSON mode: "Z" for UTC, offset otherwise
+        text = value.isoformat()
+        if value.utcoffset() is not None and value.utcoffset().total_seconds() == 0:
+            text = text[:-6] + "Z"
+        return text
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """Compact UTF-8 JSON, matching FastAPI's JSONResponse output byte for byte"""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":"), default=_default).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def render(content: Any, adapter: Optional[TypeAdapter] = None) -> Any:
+    """Return value for a route: a ready response in fast mode, else the content for response_model"""
+    if not FAST_RENDER:
+        return content
+    if RENDER_VALIDATE and adapter is not None:
+        adapter.validate_python(content)
+    return FastJSONResponse(content)
@@ -47,6 +47,11 @@ class CharacterOut(BaseModel):
     nsfw_allowed: bool
     created_at: datetime
 
+class CharacterPage(BaseModel):
+    items: List[CharacterOut]
+    next_cursor: Optional[str] = Field(None, description="Pass as `cursor` to load the next (older) page")
+    has_more: bool = False
+
 class MessageOut(BaseModel):
     id: str
     character_id: str
@@ -55,12 +60,26 @@ class MessageOut(BaseModel):
     role: Literal["user", "character"]
     created_at: datetime
 
+class MessagePage(BaseModel):
+    items: List[MessageOut]
+    prev_cursor: Optional[str] = Field(None, description="Pass as `before` to load older messages")
+    next_cursor: Optional[str] = Field(None, description="Pass as `after` to load newer messages")
+    has_more: bool = Field(False, description="More messages exist in the direction of travel")
+
+class BulkUpsertResult(BaseModel):
+    received: int
+    matched: int
+    modified: int
+    upserted: int
+
 class ImageJobOut(BaseModel):
     id: str
     character_id: str
     username: str
     prompt: str
+    style: Optional[str] = None
     rating: Literal["SFW", "NSFW"]
-    status: Literal["queued", "completed", "blocked"]
+    status: Literal["queued", "completed", "failed", "blocked"]
     image_url: Optional[str] = None
+    message: Optional[str] = None
     created_at: datetime
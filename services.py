@@ -0,0 +1,508 @@
+"""
+Shared Route Helpers
+
+Driver-independent pieces of the API: document shaping, pagination cursors,
+the reply generator and image job documents. Used by both the sync routes
+in main.py and the async routes in async_routes.py so the two stay in step.
+"""
+
+import base64
+import hashlib
+import importlib
+import json
+import os
+import re
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+from fastapi import HTTPException
+from pydantic import BaseModel, TypeAdapter
+from starlette.concurrency import iterate_in_threadpool
+
+from rendering import dumps
+from schemas import Character, CharacterOut, CharacterPage, ImageJobOut, ImageRequest, MessageOut, MessagePage, UserProfile
+
+# Chronological order of a conversation; _id breaks created_at ties
+HISTORY_SORT = [("created_at", 1), ("_id", 1)]
+
+# Newest characters first, matching the character index
+CHARACTER_SORT = [("created_at", -1), ("_id", -1)]
+
+# Server-side shapes: aggregation stages that return documents already in
+# CharacterOut / MessageOut form (id instead of _id, model field order,
+# defaults applied), so they are rendered without a per-document copy or model.
+CHARACTER_SHAPE = {"$replaceRoot": {"newRoot": {
+    "id": "$_id",
+    "name": "$name",
+    "personality": "$personality",
+    "appearance": {"$ifNull": ["$appearance", None]},
+    "location": {"$ifNull": ["$location", None]},
+    "creator_username": "$creator_username",
+    "nsfw_allowed": {"$ifNull": ["$nsfw_allowed", False]},
+    "created_at": "$created_at",
+}}}
+
+MESSAGE_SHAPE = {"$replaceRoot": {"newRoot": {
+    "id": "$_id",
+    "character_id": "$character_id",
+    "username": "$username",
+    "text": "$text",
+    "role": "$role",
+    "created_at": "$created_at",
+}}}
+
+# API version from which POST /chat/{character_id}/messages answers with only
+# the turn it created instead of the whole conversation.
+DELTA_RESPONSE_API_VERSION = 2
+
+# API version from which GET /characters and GET /chat/{character_id}/messages
+# answer with a cursor page by default. Older clients keep getting the whole
+# list unless they pass a paging parameter.
+PAGED_LIST_API_VERSION = 2
+DEFAULT_PAGE_SIZE = 50
+
+
+# Utils
+
+def doc_to_str_id(doc: dict) -> dict:
+    d = doc.copy()
+    if "_id" in d:
+        d["id"] = str(d.pop("_id"))
+    return d
+
+
+def shaped_pipeline(query: dict, sort: List[Tuple[str, int]], limit: Optional[int], shape: dict) -> List[dict]:
+    """Aggregation equivalent of find(query).sort(sort).limit(limit), returning shaped documents"""
+    pipeline = [{"$match": query}, {"$sort": dict(sort)}]
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline.append(shape)
+    return pipeline
+
+
+def encode_cursor(doc: dict) -> str:
+    """Opaque keyset cursor for a document's (created_at, _id) position (raw or shaped document)"""
+    created_at = doc["created_at"]
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    doc_id = doc["_id"] if "_id" in doc else doc["id"]
+    # Mongo stores datetimes with millisecond precision
+    raw = json.dumps([int(created_at.timestamp() * 1000), str(doc_id)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> tuple:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        millis, doc_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        created_at = datetime.fromtimestamp(int(millis) / 1000, tz=timezone.utc)
+        return created_at, str(doc_id)
+    # Out-of-range timestamps raise OverflowError / OSError from fromtimestamp
+    except (ValueError, TypeError, OverflowError, OSError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_filter(token: str, op: str) -> dict:
+    """Match documents strictly before ($lt) or after ($gt) a cursor on (created_at, _id)"""
+    created_at, doc_id = decode_cursor(token)
+    return {"$or": [
+        {"created_at": {op: created_at}},
+        {"created_at": created_at, "_id": {op: doc_id}},
+    ]}
+
+
+# Users
+
+# Fields UserProfile needs
+PROFILE_PROJECTION = {"_id": 0, "username": 1, "age": 1, "trust_score": 1}
+
+# Upper bound on profiles per POST /users/bulk request
+BULK_USERS_MAX = 5000
+
+
+def profile_upsert(profile: UserProfile) -> Tuple[dict, dict]:
+    """Filter and update document that create or refresh a profile in one atomic operation"""
+    now = datetime.now(timezone.utc)
+    payload = profile.model_dump()
+    payload["updated_at"] = now
+    update = {
+        "$set": payload,
+        "$setOnInsert": {"_id": profile.username, "created_at": now},  # readable primary key
+    }
+    return {"username": profile.username}, update
+
+
+# Response shaping
+
+def profile_out(doc: dict) -> UserProfile:
+    return UserProfile(**{k: doc.get(k) for k in ["username", "age", "trust_score"]})
+
+
+# Field order matches CharacterOut / MessageOut so both render paths emit the same bytes
+def character_dict(doc: dict) -> dict:
+    return {
+        "id": str(doc["_id"]),
+        "name": doc["name"],
+        "personality": doc["personality"],
+        "appearance": doc.get("appearance"),
+        "location": doc.get("location"),
+        "creator_username": doc["creator_username"],
+        "nsfw_allowed": doc.get("nsfw_allowed", False),
+        "created_at": doc["created_at"],
+    }
+
+
+def message_dict(doc: dict) -> dict:
+    return {
+        "id": str(doc["_id"]),
+        "character_id": doc["character_id"],
+        "username": doc["username"],
+        "text": doc["text"],
+        "role": doc["role"],
+        "created_at": doc["created_at"],
+    }
+
+
+# Bulk validators for RENDER_VALIDATE=1
+MESSAGE_LIST_ADAPTER = TypeAdapter(List[MessageOut])
+MESSAGE_PAGE_ADAPTER = TypeAdapter(MessagePage)
+CHARACTER_LIST_ADAPTER = TypeAdapter(List[CharacterOut])
+CHARACTER_PAGE_ADAPTER = TypeAdapter(CharacterPage)
+
+
+# Characters
+
+def new_character_doc(character: Character) -> dict:
+    data = character.model_dump()
+    now = datetime.now(timezone.utc)
+    data["created_at"] = now
+    data["updated_at"] = now
+    data["_id"] = str(uuid4())
+    return data
+
+
+def character_page_query(cursor: Optional[str]) -> dict:
+    """Filter for the page of characters older than `cursor`"""
+    return keyset_filter(cursor, "$lt") if cursor else {}
+
+
+def build_character_page(docs: List[dict], limit: int) -> dict:
+    """Wrap up to limit + 1 CHARACTER_SHAPE documents into a newest-first CharacterPage"""
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    return {
+        "items": docs,
+        "next_cursor": encode_cursor(docs[-1]) if has_more else None,
+        "has_more": has_more,
+    }
+
+
+# Chat messages
+class ChatIn(BaseModel):
+    username: str
+    text: str
+
+
+class ThreadMessageIn(BaseModel):
+    text: str
+
+
+class ReplyGenerator:
+    """Backend interface: stream a character's reply as text chunks.
+
+    Backends implement stream(); astream() drives it on the threadpool unless
+    a backend with a native async client overrides it.
+    """
+
+    def stream(self, character: dict, user_text: str) -> Iterator[str]:
+        raise NotImplementedError
+
+    async def astream(self, character: dict, user_text: str) -> AsyncIterator[str]:
+        async for chunk in iterate_in_threadpool(self.stream(character, user_text)):
+            yield chunk
+
+
+class TemplateReplyGenerator(ReplyGenerator):
+    """Offline backend: a canned, persona-flavoured reply streamed word by word"""
+
+    def stream(self, character: dict, user_text: str) -> Iterator[str]:
+        persona = character.get("personality", "kind and helpful")
+        name = character.get("name", "Your character")
+        prompt_safe = user_text[:400]
+        reply = (
+            f"{name}: As a {persona} character, I hear you say: '{prompt_safe}'. "
+            "Here's my friendly response: I'm excited to chat and co-create images. "
+            "Share more about style, mood, and setting!"
+        )
+        for word in re.findall(r"\S+\s*", reply):
+            yield word
+
+
+def load_reply_generator(spec: str) -> ReplyGenerator:
+    """Instantiate a backend from "template" or a "module:ClassName" path"""
+    if spec == "template":
+        return TemplateReplyGenerator()
+    module_name, _, class_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+reply_generator = load_reply_generator(os.getenv("REPLY_BACKEND", "template"))
+
+
+def generate_character_reply(character: dict, user_text: str) -> str:
+    return "".join(reply_generator.stream(character, user_text))
+
+
+async def agenerate_character_reply(character: dict, user_text: str) -> str:
+    """generate_character_reply for the event loop: drains astream(), never blocking the loop"""
+    return "".join([chunk async for chunk in reply_generator.astream(character, user_text)])
+
+
+def new_user_message(character_id: str, payload: ChatIn) -> dict:
+    now = datetime.now(timezone.utc)
+    return {
+        "_id": str(uuid4()),
+        "character_id": character_id,
+        "username": payload.username,
+        # The user whose conversation thread this turn belongs to
+        "owner": payload.username,
+        "text": payload.text,
+        "role": "user",
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def new_character_message(char: dict, character_id: str, text: str, user_msg: dict) -> dict:
+    # Stamped at least 1ms after the user message so the (created_at, _id)
+    # keyset order keeps the turn in sequence.
+    reply_at = max(datetime.now(timezone.utc), user_msg["created_at"] + timedelta(milliseconds=1))
+    return {
+        "_id": str(uuid4()),
+        "character_id": character_id,
+        "username": char.get("name", "character"),
+        "owner": user_msg["owner"],
+        "text": text,
+        "role": "character",
+        "created_at": reply_at,
+        "updated_at": reply_at,
+    }
+
+
+def build_turn(char: dict, character_id: str, payload: ChatIn) -> Tuple[dict, dict]:
+    """Build the user message and the character reply documents for one chat turn"""
+    user_msg = new_user_message(character_id, payload)
+    char_msg = new_character_message(char, character_id, generate_character_reply(char, payload.text), user_msg)
+    return user_msg, char_msg
+
+
+async def abuild_turn(char: dict, character_id: str, payload: ChatIn) -> Tuple[dict, dict]:
+    user_msg = new_user_message(character_id, payload)
+    text = await agenerate_character_reply(char, payload.text)
+    return user_msg, new_character_message(char, character_id, text, user_msg)
+
+
+def sse_event(event: str, data: dict) -> str:
+    """One Server-Sent Events frame with a JSON payload"""
+    return f"event: {event}\ndata: {dumps(data).decode()}\n\n"
+
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def resolve_return_mode(return_mode: Optional[str], api_version: int) -> str:
+    if return_mode is None:
+        return "delta" if api_version >= DELTA_RESPONSE_API_VERSION else "full"
+    return return_mode
+
+
+def wants_page(api_version: int, *params) -> bool:
+    """Whether a list endpoint serves a cursor page rather than the bare list of API v1"""
+    return api_version >= PAGED_LIST_API_VERSION or any(p is not None for p in params)
+
+
+def message_page_query(character_id: str, before: Optional[str], after: Optional[str],
+                       owner: Optional[str] = None) -> Tuple[dict, int]:
+    """Filter and sort direction for one page of a conversation.
+
+    With `owner`, the page is limited to that user's thread with the character.
+    Walks forward from an `after` cursor, otherwise backwards from the newest
+    message (or from `before`).
+    """
+    clauses = [{"character_id": character_id} if owner is None else {"owner": owner, "character_id": character_id}]
+    if before:
+        clauses.append(keyset_filter(before, "$lt"))
+    if after:
+        clauses.append(keyset_filter(after, "$gt"))
+    query = clauses[0] if len(clauses) == 1 else {"$and": clauses}
+    direction = 1 if after and not before else -1
+    return query, direction
+
+
+def build_message_page(msgs: List[dict], limit: int, direction: int,
+                       before: Optional[str], after: Optional[str]) -> dict:
+    """Wrap up to limit + 1 MESSAGE_SHAPE documents into a chronological MessagePage"""
+    has_more = len(msgs) > limit
+    msgs = msgs[:limit]
+    if direction == -1:
+        msgs.reverse()
+    return {
+        "items": msgs,
+        "prev_cursor": encode_cursor(msgs[0]) if msgs else before,
+        "next_cursor": encode_cursor(msgs[-1]) if msgs else after,
+        "has_more": has_more,
+    }
+
+
+# Export
+
+# Bytes buffered before a chunk of NDJSON is sent
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+
+def export_query(character_id: Optional[str], username: Optional[str],
+                 since: Optional[datetime], until: Optional[datetime], owner: Optional[str] = None) -> dict:
+    query = {}
+    if owner:
+        query["owner"] = owner
+    if character_id:
+        query["character_id"] = character_id
+    if username:
+        query["username"] = username
+    if since or until:
+        query["created_at"] = {}
+        if since:
+            query["created_at"]["$gte"] = since
+        if until:
+            query["created_at"]["$lt"] = until
+    return query
+
+
+def export_sort(character_id: Optional[str]) -> Optional[List[Tuple[str, int]]]:
+    # Chronological per character (served by the message index); whole-collection
+    # exports stream in natural order rather than sorting the collection.
+    return HISTORY_SORT if character_id else None
+
+
+def export_filename(compress: bool) -> dict:
+    name = "messages.ndjson.gz" if compress else "messages.ndjson"
+    return {"Content-Disposition": f'attachment; filename="{name}"'}
+
+
+def export_dict(doc: dict) -> dict:
+    """Export row: the API message shape plus the thread owner, so replies stay attributable"""
+    row = message_dict(doc)
+    row["owner"] = doc.get("owner")
+    row["updated_at"] = doc.get("updated_at")
+    return row
+
+
+class NDJSONEncoder:
+    """Accumulates message documents as NDJSON, optionally gzip-compressed, in bounded chunks"""
+
+    def __init__(self, compress: bool = False):
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        self._buffer = bytearray()
+
+    @property
+    def media_type(self) -> str:
+        return "application/gzip" if self._compressor else "application/x-ndjson"
+
+    def add(self, doc: dict) -> Optional[bytes]:
+        """Buffer one document; returns a chunk to send once the buffer is full"""
+        self._buffer += dumps(export_dict(doc))
+        self._buffer += b"\n"
+        if len(self._buffer) >= EXPORT_CHUNK_BYTES:
+            return self._flush()
+        return None
+
+    def finish(self) -> bytes:
+        chunk = self._flush()
+        if self._compressor:
+            chunk += self._compressor.flush()
+        return chunk
+
+    def _flush(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return self._compressor.compress(data) if self._compressor else data
+
+
+def ndjson_chunks(docs: Iterable[dict], encoder: NDJSONEncoder) -> Iterator[bytes]:
+    for doc in docs:
+        chunk = encoder.add(doc)
+        if chunk:
+            yield chunk
+    yield encoder.finish()
+
+
+async def andjson_chunks(docs: AsyncIterable[dict], encoder: NDJSONEncoder) -> AsyncIterator[bytes]:
+    async for doc in docs:
+        chunk = encoder.add(doc)
+        if chunk:
+            yield chunk
+    yield encoder.finish()
+
+
+# Image generation (demo: SFW placeholder, NSFW gated and blocked in this demo)
+NSFW_BLOCKED_MESSAGE = (
+    "NSFW image generation is gated and disabled in this demo. "
+    "Earn trust and ensure adult age in a production-ready system."
+)
+
+
+def _normalize_text(value: Optional[str]) -> str:
+    return " ".join((value or "").split()).casefold()
+
+
+def image_cache_key(req: ImageRequest) -> str:
+    """Stable content hash of the normalized (character, prompt, style, rating) request.
+
+    Unlike hash(), this is identical in every process and across restarts, so
+    it can seed the generator and key the result cache.
+    """
+    normalized = [req.character_id, _normalize_text(req.prompt), _normalize_text(req.style), req.rating]
+    return hashlib.sha256(json.dumps(normalized, separators=(",", ":")).encode()).hexdigest()
+
+
+def new_image_job(char: dict, req: ImageRequest) -> dict:
+    """Job document for an image request; NSFW requests are stored already blocked"""
+    now = datetime.now(timezone.utc)
+    job = {
+        "_id": str(uuid4()),
+        "character_id": req.character_id,
+        "username": req.username,
+        "prompt": req.prompt,
+        "style": req.style,
+        "rating": req.rating,
+        # Everything the generator needs, so workers never re-read the character
+        "description": f"{char.get('name')} | {char.get('personality')} | {char.get('appearance') or ''} | {char.get('location') or ''} | {req.prompt}",
+        "cache_key": image_cache_key(req),
+        "status": "queued",
+        "image_url": None,
+        "message": "Queued for generation",
+        "created_at": now,
+        "updated_at": now,
+    }
+    if req.rating == "NSFW":
+        job["status"] = "blocked"
+        job["message"] = NSFW_BLOCKED_MESSAGE
+    return job
+
+
+def image_job_out(doc: dict) -> ImageJobOut:
+    d = doc_to_str_id(doc)
+    return ImageJobOut(
+        id=d["id"],
+        character_id=d["character_id"],
+        username=d["username"],
+        prompt=d["prompt"],
+        style=d.get("style"),
+        rating=d["rating"],
+        status=d["status"],
+        image_url=d.get("image_url"),
+        message=d.get("message"),
+        created_at=d["created_at"],
+    )
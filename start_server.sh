@@ -1,19 +1,64 @@
 #!/bin/bash
-echo "Starting FastAPI backend server..."
-
-# Find and kill MainThread processes
-PIDS=$(ps | grep uvicorn | grep -v grep | awk '{print $1}')
-if [ ! -z "$PIDS" ]; then
-  echo "Killing uvicorn processes: $PIDS"
-  for pid in $PIDS; do
-    kill $pid 2>/dev/null || true
-  done
-  sleep 2
-fi
+# Usage: ./start_server.sh [prod|dev|stop|reload]   (default: prod)
+#
+#   prod    gunicorn + uvicorn workers (gunicorn.conf.py), one per CPU
+#   dev     single uvicorn process with --reload
+#   stop    drain and stop the running server
+#   reload  graceful rolling restart of the prod workers
+#
+# Dependencies are not installed here; run `pip install -r requirements.txt` once.
+cd "$(dirname "$0")"
 
+MODE="${1:-prod}"
+export PIDFILE="${PIDFILE:-logs/server.pid}"
 mkdir -p logs
-echo "Installing dependencies..."
-pip install -r requirements.txt
-echo "Starting FastAPI server..."
-nohup uvicorn main:app --host 0.0.0.0 --port 8000 --reload > logs/server.log 2>&1 
-echo "Server started in background"
+
+running() {
+  [ -f "$PIDFILE" ] && kill -0 "$(cat "$PIDFILE")" 2>/dev/null
+}
+
+stop() {
+  if running; then
+    PID=$(cat "$PIDFILE")
+    echo "Stopping server (pid $PID)..."
+    kill -TERM "$PID"
+    # Wait for in-flight requests to drain (gunicorn graceful_timeout + margin)
+    for _ in $(seq 1 "$(( ${GRACEFUL_TIMEOUT:-30} + 5 ))"); do
+      kill -0 "$PID" 2>/dev/null || break
+      sleep 1
+    done
+  fi
+  rm -f "$PIDFILE"
+}
+
+case "$MODE" in
+  prod)
+    stop
+    echo "Starting FastAPI server (gunicorn, ${WEB_CONCURRENCY:-$(nproc)} workers)..."
+    nohup gunicorn -c gunicorn.conf.py main:app >> logs/server.log 2>&1 &
+    echo "Server started in background"
+    ;;
+  dev)
+    stop
+    echo "Starting FastAPI server (uvicorn --reload)..."
+    nohup uvicorn main:app --host 0.0.0.0 --port "${PORT:-8000}" --reload --reload-include "*.py" >> logs/server.log 2>&1 &
+    echo $! > "$PIDFILE"
+    echo "Server started in background"
+    ;;
+  stop)
+    stop
+    ;;
+  reload)
+    if running; then
+      kill -HUP "$(cat "$PIDFILE")"
+      echo "Workers restarting"
+    else
+      echo "Server is not running"
+      exit 1
+    fi
+    ;;
+  *)
+    echo "Usage: $0 [prod|dev|stop|reload]"
+    exit 1
+    ;;
+esac
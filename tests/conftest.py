@@ -0,0 +1,31 @@
+"""
+Test Setup
+
+Runs the storage code against mongomock: an in-memory client stands in for
+MongoClient, and every collection is dropped after each test.
+"""
+
+import os
+import sys
+
+import mongomock
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DATABASE_NAME", "test")
+# Tests of the app share one client address; test_ratelimit.py builds its own limiter
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+
+import database  # noqa: E402
+
+_client = mongomock.MongoClient(tz_aware=False)
+database.MongoClient = lambda *args, **kwargs: _client
+
+
+@pytest.fixture
+def db():
+    db = database.get_db()
+    yield db
+    for name in db.list_collection_names():
+        db.drop_collection(name)
@@ -0,0 +1,16 @@
+from datetime import datetime, timedelta, timezone
+
+T0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def message(i: int, character_id: str = "c1", owner: str = "amy", at: datetime = T0) -> dict:
+    """Message document number `i` of a conversation, one second apart"""
+    return {
+        "_id": f"m{i:04d}",
+        "character_id": character_id,
+        "username": owner if i % 2 == 0 else "Ann",
+        "owner": owner,
+        "text": f"text {i}",
+        "role": "user" if i % 2 == 0 else "character",
+        "created_at": at + timedelta(seconds=i),
+    }
@@ -0,0 +1,126 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import archive
+from helpers import message
+
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def stats():
+    return {"messages": 0, "chunks": 0, "skipped": 0}
+
+
+def archived_ids(db):
+    return sorted(m["_id"] for chunk in db["messagearchive"].find() for m in archive.unpack(chunk)["messages"])
+
+
+def bucket(db, messages, _id="b1"):
+    db["messagebucket"].insert_one({
+        "_id": _id, "character_id": "c1", "owner": "amy", "count": len(messages),
+        "first_at": messages[0]["created_at"], "last_at": messages[-1]["created_at"], "messages": messages,
+    })
+
+
+def test_pack_round_trip():
+    messages = [message(i) for i in range(3)]
+    chunk = archive.archive_chunk(messages)
+    assert chunk["_id"] == "archive-m0000"
+    assert chunk["count"] == 3
+    assert [m["_id"] for m in archive.unpack(chunk)["messages"]] == ["m0000", "m0001", "m0002"]
+
+
+def test_run_moves_messages_and_pages_them(db, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_CHUNK_SIZE", 4)
+    db["message"].insert_many([message(i) for i in range(10)] + [message(i, owner="bob") for i in range(20, 23)])
+    db["message"].insert_one(message(99, at=NOW))  # too recent
+
+    result = archive.run_archive(now=NOW, after_days=30)
+
+    assert result["messages"] == 13
+    assert result["chunks"] == 4
+    assert [m["_id"] for m in db["message"].find()] == ["m0099"]
+    page = archive.page({"character_id": "c1", "owner": "amy"}, 5, None, None)
+    assert [m["id"] for m in page["items"]] == [f"m{i:04d}" for i in range(5, 10)]
+    older = archive.page({"character_id": "c1", "owner": "amy"}, 5, page["prev_cursor"], None)
+    assert [m["id"] for m in older["items"]] == [f"m{i:04d}" for i in range(5)]
+    assert not older["has_more"]
+
+
+def test_rerun_after_crash_archives_the_rest(db):
+    db["message"].insert_many([message(i) for i in range(5)])
+    # A crashed run stored a chunk of the first three but deleted nothing
+    archive.store_chunk([message(i) for i in range(3)], stats())
+
+    result = archive.run_archive(now=NOW, after_days=30)
+
+    assert result["messages"] == 5
+    assert db["message"].count_documents({}) == 0
+    assert archived_ids(db) == [f"m{i:04d}" for i in range(5)]
+    assert archive.run_archive(now=NOW, after_days=30)["messages"] == 0
+
+
+def test_overlapping_bucket_runs_keep_the_chunk(db):
+    messages = [message(i) for i in range(3)]
+    bucket(db, messages)
+    real_store = archive.store_chunk
+
+    def store_then_other_worker(batch, run_stats):
+        held = real_store(batch, run_stats)
+        # Another worker archives the same bucket before this one deletes it
+        archive.store_chunk = real_store
+        archive.archive_buckets(NOW, stats())
+        return held
+
+    archive.store_chunk = store_then_other_worker
+    try:
+        archive.archive_buckets(NOW, stats())
+    finally:
+        archive.store_chunk = real_store
+
+    assert db["messagebucket"].count_documents({}) == 0
+    assert archived_ids(db) == ["m0000", "m0001", "m0002"]
+
+
+def test_bucket_grown_since_read_stays_hot(db):
+    messages = [message(i) for i in range(3)]
+    bucket(db, messages)
+    real_store = archive.store_chunk
+
+    def store_then_append(batch, run_stats):
+        db["messagebucket"].update_one({"_id": "b1"}, {"$push": {"messages": message(3, at=NOW)}, "$inc": {"count": 1}})
+        return real_store(batch, run_stats)
+
+    archive.store_chunk = store_then_append
+    try:
+        archive.archive_buckets(NOW, stats())
+    finally:
+        archive.store_chunk = real_store
+
+    assert db["messagebucket"].find_one()["count"] == 4
+    # When the bucket ages again, the archived part is recognised and only the rest is added
+    db["messagebucket"].update_one({"_id": "b1"}, {"$set": {"last_at": messages[-1]["created_at"]}})
+    run_stats = stats()
+    archive.archive_buckets(NOW, run_stats)
+    assert db["messagebucket"].count_documents({}) == 0
+    assert archived_ids(db) == ["m0000", "m0001", "m0002", "m0003"]
+
+
+def test_run_skips_while_another_process_holds_the_lease(db):
+    db["message"].insert_many([message(i) for i in range(3)])
+    assert archive.acquire_lease("archive", "other", 60)
+
+    assert archive.run_archive(now=NOW, after_days=30)["busy"]
+    assert db["message"].count_documents({}) == 3
+
+    archive.release_lease("archive", "other")
+    assert archive.run_archive(now=NOW, after_days=30)["messages"] == 3
+    assert db["joblock"].count_documents({}) == 0
+
+
+@pytest.mark.parametrize("after_days", [0, -1])
+def test_disabled(db, after_days):
+    db["message"].insert_many([message(i) for i in range(3)])
+    assert archive.run_archive(now=NOW, after_days=after_days)["messages"] == 0
+    assert db["message"].count_documents({}) == 3
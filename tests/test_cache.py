@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import cache
+from cache import AsyncSingleFlight, SingleFlight, TTLCache
+
+
+def test_evicts_least_recently_used():
+    c = TTLCache(maxsize=2)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")
+    c.set("c", 3)
+    assert (c.get("a"), c.get("b"), c.get("c")) == (1, None, 3)
+    assert c.stats()["evictions"] == 1
+
+
+def test_entries_expire(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: clock[0])
+    c = TTLCache(ttl=10)
+    c.set("a", 1)
+    c.set("b", 2, ttl=60)
+    clock[0] += 11
+    assert (c.get("a"), c.get("b")) == (None, 2)
+    assert c.stats()["expirations"] == 1
+
+
+def test_memory_bound():
+    value = {"text": "x" * 1000}
+    size = cache.approx_size(value)
+    c = TTLCache(max_bytes=size * 2)
+    for key in "abc":
+        c.set(key, value)
+    assert c.stats()["entries"] == 2
+    assert c.stats()["bytes"] <= size * 2
+    assert c.get("a") is None
+    # Anything over the whole budget is not cached at all
+    c.set("big", {"text": "x" * size * 3})
+    assert c.get("big") is None
+    assert c.stats()["entries"] == 2
+
+
+def test_single_flight_coalesces_threads():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def load():
+        calls.append(1)
+        release.wait(5)
+        return "page"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("k", load))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while flight.coalesced < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
+    assert results == ["page"] * 5
+    # Finished calls are forgotten
+    assert flight.do("k", lambda: "fresh") == "fresh"
+
+
+def test_single_flight_forgets_failed_calls():
+    flight = SingleFlight()
+
+    def fail():
+        raise RuntimeError("db down")
+
+    with pytest.raises(RuntimeError):
+        flight.do("k", fail)
+    assert flight.do("k", lambda: 1) == 1
+
+
+def test_async_single_flight_coalesces():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "page"
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", load) for _ in range(5)))
+
+    assert asyncio.run(run()) == ["page"] * 5
+    assert calls == [1]
+    assert flight.coalesced == 4
@@ -0,0 +1,96 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import metrics
+from idempotency import IdempotencyMiddleware, IdempotencyStore
+
+
+def make_client(store, payload_size=10, with_metrics=False):
+    app = FastAPI()
+    calls = []
+
+    @app.post("/chat/{character_id}/messages")
+    def post(character_id: str, body: dict):
+        calls.append(body)
+        return {"n": len(calls), "pad": "x" * payload_size}
+
+    app.add_middleware(IdempotencyMiddleware, store=store)
+    if with_metrics:
+        app.add_middleware(metrics.MetricsMiddleware)
+    return TestClient(app), calls
+
+
+def test_replays_stored_response(db):
+    store = IdempotencyStore()
+    client, calls = make_client(store)
+    headers = {"Idempotency-Key": "k1"}
+    first = client.post("/chat/c1/messages", json={"text": "hi"}, headers=headers)
+    store.completed.clear()  # replay from the collection
+    again = client.post("/chat/c1/messages", json={"text": "hi"}, headers=headers)
+
+    assert len(calls) == 1
+    assert again.content == first.content
+    assert again.headers["idempotent-replayed"] == "true"
+
+
+def test_different_body_is_422(db):
+    client, _ = make_client(IdempotencyStore())
+    client.post("/chat/c1/messages", json={"text": "hi"}, headers={"Idempotency-Key": "k1"})
+    assert client.post("/chat/c1/messages", json={"text": "bye"}, headers={"Idempotency-Key": "k1"}).status_code == 422
+
+
+def test_in_progress_is_409(db):
+    store = IdempotencyStore()
+    client, calls = make_client(store)
+    first = client.post("/chat/c1/messages", json={"text": "hi"}, headers={"Idempotency-Key": "k0"})
+    fingerprint = db["idempotencykey"].find_one()["fingerprint"]
+    assert first.status_code == 200
+    assert store.claim("/chat/c1/messages|k1", fingerprint) is None
+
+    response = client.post("/chat/c1/messages", json={"text": "hi"}, headers={"Idempotency-Key": "k1"})
+
+    assert response.status_code == 409
+    assert len(calls) == 1
+
+
+def test_large_body_is_not_stored(db):
+    store = IdempotencyStore(max_body_bytes=100)
+    client, calls = make_client(store, payload_size=1000)
+    headers = {"Idempotency-Key": "k1"}
+    client.post("/chat/c1/messages", json={"text": "hi"}, headers=headers)
+    store.completed.clear()
+    again = client.post("/chat/c1/messages", json={"text": "hi"}, headers=headers)
+
+    assert len(calls) == 1
+    assert again.status_code == 200
+    assert again.content == b""
+    assert again.headers["idempotent-body-omitted"] == "true"
+    assert db["idempotencykey"].find_one()["response_body"] is None
+
+
+def test_failed_store_frees_the_key(db):
+    store = IdempotencyStore()
+    client, calls = make_client(store)
+
+    def fail(*args):
+        raise RuntimeError("document too large")
+
+    store.complete = fail
+    client.post("/chat/c1/messages", json={"text": "hi"}, headers={"Idempotency-Key": "k1"})
+    del store.complete
+    retry = client.post("/chat/c1/messages", json={"text": "hi"}, headers={"Idempotency-Key": "k1"})
+
+    assert retry.status_code == 200
+    assert len(calls) == 2
+
+
+def test_replay_is_counted_under_the_route(db):
+    client, calls = make_client(IdempotencyStore(), with_metrics=True)
+    key = ("POST", "/chat/{character_id}/messages", "200")
+    client.post("/chat/c1/messages", json={"text": "hi"}, headers={"Idempotency-Key": "k1"})
+    before = metrics.http_requests._values[key]
+    again = client.post("/chat/c1/messages", json={"text": "hi"}, headers={"Idempotency-Key": "k1"})
+
+    assert again.headers["idempotent-replayed"] == "true"
+    assert len(calls) == 1
+    assert metrics.http_requests._values[key] == before + 1
@@ -0,0 +1,87 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from cache import character_cache
+from image_jobs import image_jobs, image_results
+
+
+@pytest.fixture
+def client(db):
+    client = TestClient(main.app)
+    yield client
+    image_jobs.shutdown()
+    image_results.memory.clear()
+    character_cache.clear()
+
+
+@pytest.fixture
+def request_body(client):
+    client.post("/users", json={"username": "amy"})
+    character = client.post("/characters", json={
+        "name": "Ada", "personality": "Curious inventor", "creator_username": "amy"}).json()
+    return {"character_id": character["id"], "username": "amy", "prompt": "A lighthouse at dusk"}
+
+
+def wait_for(client, job_id, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(f"/images/{job_id}").json()
+        if job["status"] != "queued" or time.monotonic() > deadline:
+            return job
+        time.sleep(0.01)
+
+
+def test_job_runs_in_the_background(client, request_body):
+    response = client.post("/images", json=request_body)
+    assert response.status_code == 202
+    assert response.json()["status"] == "queued"
+
+    job = wait_for(client, response.json()["id"])
+    assert job["status"] == "completed"
+    assert job["image_url"].startswith("https://")
+
+
+def test_failed_generation_is_recorded(client, request_body, monkeypatch):
+    def fail(job):
+        raise RuntimeError("backend unavailable")
+
+    monkeypatch.setattr(image_jobs.generator, "generate", fail)
+    job = wait_for(client, client.post("/images", json=request_body).json()["id"])
+    assert job["status"] == "failed"
+    assert "backend unavailable" in job["message"]
+
+
+def test_nsfw_is_blocked_without_a_job(client, request_body):
+    response = client.post("/images", json={**request_body, "rating": "NSFW"})
+    assert response.status_code == 200
+    assert response.json()["status"] == "blocked"
+
+
+def test_unknown_job_is_404(client):
+    assert client.get("/images/nope").status_code == 404
+
+
+def test_identical_request_is_served_from_the_cache(client, request_body, monkeypatch):
+    first = wait_for(client, client.post("/images", json=request_body).json()["id"])
+    calls = []
+    monkeypatch.setattr(image_jobs, "submit", calls.append)
+
+    # Same request up to case and whitespace
+    response = client.post("/images", json={**request_body, "prompt": "  a LIGHTHOUSE   at dusk "})
+    assert response.status_code == 200
+    assert response.json()["status"] == "completed"
+    assert response.json()["image_url"] == first["image_url"]
+    assert calls == []
+
+
+def test_seed_depends_on_the_request(client, request_body):
+    first = wait_for(client, client.post("/images", json=request_body).json()["id"])
+    image_results.memory.clear()
+    again = wait_for(client, client.post("/images", json=request_body).json()["id"])
+    other = wait_for(client, client.post("/images", json={**request_body, "style": "watercolor"}).json()["id"])
+
+    assert again["image_url"] == first["image_url"]
+    assert other["image_url"] != first["image_url"]
@@ -0,0 +1,134 @@
+from datetime import timedelta
+
+import pytest
+
+import message_store
+from helpers import T0, message
+from message_store import BucketPager, bucket_page_query
+from services import encode_cursor
+
+
+def buckets_of(messages, size):
+    chunks = [messages[i:i + size] for i in range(0, len(messages), size)]
+    return [{"first_at": c[0]["created_at"], "last_at": c[-1]["created_at"], "messages": c} for c in chunks]
+
+
+def pager_page(buckets, limit, before=None, after=None):
+    _, _, direction, lower, upper = bucket_page_query({}, before, after)
+    ordered = sorted(buckets, key=lambda b: b["last_at"], reverse=True) if direction == -1 \
+        else sorted(buckets, key=lambda b: b["first_at"])
+    pager = BucketPager(limit, direction, lower, upper)
+    fed = 0
+    for bucket in ordered:
+        if not pager.feed(bucket):
+            break
+        fed += 1
+    return [m["_id"] for m in pager.items], fed
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 50])
+def test_pager_matches_sorted_slices(size):
+    messages = [message(i) for i in range(23)]
+    buckets = buckets_of(messages, size)
+    ids = [m["_id"] for m in messages]
+    for limit in (1, 5, 10):
+        newest, _ = pager_page(buckets, limit)
+        assert newest == ids[::-1][:limit + 1]
+        for pos, m in enumerate(messages):
+            cursor = encode_cursor(m)
+            older, _ = pager_page(buckets, limit, before=cursor)
+            assert older == ids[:pos][::-1][:limit + 1]
+            newer, _ = pager_page(buckets, limit, after=cursor)
+            assert newer == ids[pos + 1:][:limit + 1]
+
+
+def test_pager_stops_early():
+    buckets = buckets_of([message(i) for i in range(100)], 10)
+    items, fed = pager_page(buckets, 5)
+    assert len(items) == 6
+    assert fed == 1
+    _, fed = pager_page(buckets, 15)
+    assert fed == 2
+
+
+def test_pager_handles_unordered_bucket_contents():
+    messages = [message(i) for i in range(6)]
+    bucket = {"first_at": messages[0]["created_at"], "last_at": messages[-1]["created_at"],
+              "messages": list(reversed(messages[3:])) + messages[:3]}
+    items, _ = pager_page([bucket], 2)
+    assert items == ["m0005", "m0004", "m0003"]
+
+
+def walk(base, limit, direction):
+    """Every message of a conversation, following prev cursors from the newest page or next cursors from the start"""
+    seen = []
+    cursor = None if direction == -1 else encode_cursor({"_id": "", "created_at": T0 - timedelta(seconds=1)})
+    while True:
+        if direction == -1:
+            page = message_store.page(base, limit, cursor, None)
+            seen = [m["id"] for m in page["items"]] + seen
+            cursor = page["prev_cursor"]
+        else:
+            page = message_store.page(base, limit, None, cursor)
+            seen += [m["id"] for m in page["items"]]
+            cursor = page["next_cursor"]
+        if not page["has_more"]:
+            return seen
+
+
+@pytest.mark.parametrize("storage", ["documents", "buckets"])
+def test_page_walk_in_both_layouts(db, monkeypatch, storage):
+    monkeypatch.setattr(message_store, "MESSAGE_STORAGE", storage)
+    monkeypatch.setattr(message_store, "BUCKET_SIZE", 4)
+    messages = [message(i) for i in range(17)] + [message(i, owner="bob") for i in range(100, 103)]
+    for i in range(0, 17, 2):
+        message_store.append(messages[i:min(i + 2, 17)])
+    message_store.append(messages[17:])
+
+    amy = message_store.conversation_filter("c1", owner="amy")
+    expected = [m["_id"] for m in messages[:17]]
+    assert walk(amy, 5, -1) == expected
+    assert walk(amy, 5, 1) == expected
+    assert [m["id"] for m in message_store.history(amy)] == expected
+    assert len(message_store.history({"character_id": "c1"})) == 20
+
+
+def test_migrate_rerun_keeps_new_messages(db, monkeypatch):
+    monkeypatch.setattr(message_store, "BUCKET_SIZE", 200)
+    db["message"].insert_many([message(i) for i in range(6)])
+    assert message_store.migrate_to_buckets()["buckets"] == 1
+
+    db["message"].insert_many([message(i) for i in range(6, 8)])
+    stats = message_store.migrate_to_buckets(delete=True)
+
+    assert stats["extended"] == 1
+    assert db["message"].count_documents({}) == 0
+    held = [m["_id"] for b in db["messagebucket"].find() for m in b["messages"]]
+    assert sorted(held) == [f"m{i:04d}" for i in range(8)]
+    assert message_store.migrate_to_buckets(delete=True)["messages"] == 0
+
+
+def test_migrate_rerun_into_full_bucket(db, monkeypatch):
+    monkeypatch.setattr(message_store, "BUCKET_SIZE", 8)
+    db["message"].insert_many([message(i) for i in range(6)])
+    message_store.migrate_to_buckets()
+    # Live writes fill the migrated bucket before the rerun
+    db["messagebucket"].update_one({}, {"$push": {"messages": {"$each": [message(50), message(51)]}},
+                                        "$inc": {"count": 2}})
+    db["message"].insert_many([message(i) for i in range(6, 8)])
+
+    stats = message_store.migrate_to_buckets(delete=True)
+
+    assert stats["buckets"] == 1
+    assert db["message"].count_documents({}) == 0
+    held = sorted(m["_id"] for b in db["messagebucket"].find() for m in b["messages"])
+    assert held == [f"m{i:04d}" for i in range(8)] + ["m0050", "m0051"]
+
+
+def test_migrate_interrupted_before_delete(db):
+    db["message"].insert_many([message(i) for i in range(5)])
+    message_store.migrate_to_buckets()
+    stats = message_store.migrate_to_buckets(delete=True)
+    assert stats["skipped"] == 1
+    assert stats["deleted"] == 5
+    assert db["messagebucket"].find_one()["count"] == 5
@@ -0,0 +1,70 @@
+from collections import deque
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+
+import main
+from database import command_stats, query_shape
+from metrics import CONTENT_TYPE, Registry
+
+
+def test_exposition_format():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ("route",))
+    registry.gauge("up", "Up", collect=lambda: {(): 1})
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    requests.inc('/say/"hi"\n')
+    requests.inc('/say/"hi"\n', amount=2)
+    for seconds in (0.05, 0.5, 5):
+        latency.observe(seconds)
+
+    assert registry.expose() == "\n".join([
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{route="/say/\\"hi\\"\\n"} 3',
+        "# HELP up Up",
+        "# TYPE up gauge",
+        "up 1",
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_sum 5.55",
+        "latency_seconds_count 3",
+    ]) + "\n"
+
+
+def test_metrics_endpoint_labels_route_templates(db):
+    client = TestClient(main.app)
+    client.get("/chat/c1/messages")
+    response = client.get("/metrics")
+
+    assert response.headers["content-type"] == CONTENT_TYPE + "; charset=utf-8"
+    assert 'http_requests_total{method="GET",route="/chat/{character_id}/messages",status="200"}' in response.text
+    assert "/chat/c1/messages" not in response.text
+
+
+def test_query_shape_redacts_literals():
+    query = {"$or": [{"owner": "amy", "created_at": {"$lt": 5}}, {"_id": {"$in": ["a", "b"]}}], "tags": []}
+    assert query_shape(query) == {
+        "$or": [{"owner": "?", "created_at": {"$lt": "?"}}, {"_id": {"$in": ["?"]}}], "tags": []}
+    pipeline = [{"$match": {"character_id": "c1"}}, {"$limit": 50}]
+    assert query_shape(pipeline) == [{"$match": {"character_id": "?"}}, {"$limit": "?"}]
+
+
+def test_slow_log_keeps_only_the_shape(monkeypatch):
+    monkeypatch.setattr(command_stats, "slow_ms", 0)
+    monkeypatch.setattr(command_stats, "slow", deque(maxlen=10))
+    command = {"find": "message", "filter": {"owner": "amy", "text": "secret"}}
+    event = SimpleNamespace(command_name="find", command=command, request_id=1, connection_id=("h", 1),
+                            duration_micros=2500)
+    command_stats.started(event)
+    command_stats.succeeded(event)
+    command_stats.started(SimpleNamespace(command_name="ping", command={"ping": 1}, request_id=2,
+                                          connection_id=("h", 1)))
+
+    [entry] = command_stats.slow_log()
+    assert entry["query_shape"] == {"owner": "?", "text": "?"}
+    assert (entry["collection"], entry["command"], entry["duration_ms"]) == ("message", "find", 2.5)
+    assert "secret" not in str(entry)
@@ -0,0 +1,98 @@
+from typing import List
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import metrics
+import ratelimit
+from ratelimit import MemoryBackend, RateLimitMiddleware
+
+
+def test_memory_backend_refills(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: clock[0])
+    backend = MemoryBackend()
+    assert [backend.take("k", 1.0, 2)[0] for _ in range(3)] == [True, True, False]
+    assert backend.take("k", 1.0, 2)[1] == pytest.approx(1.0)
+    clock[0] += 1.0
+    assert backend.take("k", 1.0, 2)[0]
+
+
+def test_mongo_backend(db):
+    backend = ratelimit.MongoBackend()
+    assert [backend.take("k", 0.001, 2)[0] for _ in range(3)] == [True, True, False]
+    assert db["ratelimit"].find_one({"_id": "k"})["expires_at"]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(ratelimit, "TRUST_FORWARDED", True)
+    monkeypatch.setattr(ratelimit, "IP_PER_MINUTE", 600)
+    monkeypatch.setattr(ratelimit, "IP_BURST", 100)
+    monkeypatch.setattr(ratelimit, "USER_PER_MINUTE", 1)
+    monkeypatch.setattr(ratelimit, "USER_BURST", 2)
+    app = FastAPI()
+
+    @app.post("/users")
+    def post(body: dict):
+        return body
+
+    app.add_middleware(RateLimitMiddleware, backend=MemoryBackend())
+    return TestClient(app)
+
+
+def post(client, ip, username, **headers):
+    return client.post("/users", json={"username": username}, headers={"X-Forwarded-For": ip, **headers}).status_code
+
+
+def test_body_username_is_limited_per_address(client):
+    assert [post(client, "10.0.0.1", "victim") for _ in range(3)] == [200, 200, 429]
+    # The same name from elsewhere has its own bucket
+    assert post(client, "10.0.0.2", "victim") == 200
+
+
+def test_trusted_user_header_keys_alone(client, monkeypatch):
+    monkeypatch.setattr(ratelimit, "USER_HEADER", b"x-authenticated-user")
+    codes = [post(client, f"10.0.0.{i}", f"name{i}", **{"X-Authenticated-User": "alice"}) for i in range(3)]
+    assert codes == [200, 200, 429]
+
+
+def test_rejections_are_counted_under_the_route(monkeypatch):
+    monkeypatch.setattr(ratelimit, "TRUST_FORWARDED", True)
+    monkeypatch.setattr(ratelimit, "IP_PER_MINUTE", 1)
+    monkeypatch.setattr(ratelimit, "IP_BURST", 1)
+    app = FastAPI()
+
+    @app.get("/chat/{character_id}/messages")
+    def messages(character_id: str):
+        return []
+
+    app.add_middleware(RateLimitMiddleware, backend=MemoryBackend())
+    app.add_middleware(metrics.MetricsMiddleware)
+    key = ("GET", "/chat/{character_id}/messages", "429")
+    before = metrics.http_requests._values.get(key, 0)
+    client = TestClient(app)
+    codes = [client.get(f"/chat/c{i}/messages", headers={"X-Forwarded-For": "10.0.0.9"}).status_code
+             for i in range(2)]
+    assert codes == [200, 429]
+    assert metrics.http_requests._values[key] == before + 1
+
+
+def test_only_chat_routes_take_the_path_username(monkeypatch):
+    monkeypatch.setattr(ratelimit, "USER_PER_MINUTE", 1)
+    monkeypatch.setattr(ratelimit, "USER_BURST", 2)
+    app = FastAPI()
+
+    @app.post("/users/bulk")
+    def bulk(profiles: List[dict]):
+        return profiles
+
+    @app.post("/users/{username}/chats/{character_id}/messages")
+    def chat(username: str, character_id: str):
+        return []
+
+    app.add_middleware(RateLimitMiddleware, backend=MemoryBackend())
+    client = TestClient(app)
+    assert [client.post("/users/bulk", json=[]).status_code for _ in range(3)] == [200] * 3
+    assert [client.post("/users/amy/chats/c1/messages").status_code for _ in range(3)] == [200, 200, 429]
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import rendering
+from cache import character_cache, character_list_cache
+from schemas import MessageOut
+
+
+@pytest.fixture
+def client(db):
+    yield TestClient(main.app)
+    character_cache.clear()
+    character_list_cache.clear()
+
+
+def render_both(client, monkeypatch, path, **headers):
+    bodies = []
+    for fast in (True, False):
+        monkeypatch.setattr(rendering, "FAST_RENDER", fast)
+        character_list_cache.clear()
+        response = client.get(path, headers=headers)
+        assert response.status_code == 200
+        bodies.append(response.content)
+    return bodies
+
+
+@pytest.mark.parametrize("path,version", [
+    ("/characters", "1"),
+    ("/characters?limit=2", "2"),
+    ("/chat/{id}/messages", "1"),
+    ("/chat/{id}/messages?limit=3", "2"),
+])
+def test_fast_path_is_byte_identical(client, monkeypatch, path, version):
+    ids = []
+    for i in range(3):
+        character = client.post("/characters", json={
+            "name": f"Character {i}", "personality": "Cheerful and curious",
+            "appearance": "Short hair, éclat", "creator_username": "amy"}).json()
+        ids.append(character["id"])
+    for text in ("hello", "how are you? ☃"):
+        client.post(f"/chat/{ids[0]}/messages", json={"username": "amy", "text": text})
+
+    fast, pydantic = render_both(client, monkeypatch, path.format(id=ids[0]), **{"X-API-Version": version})
+    assert fast == pydantic
+
+
+@pytest.mark.parametrize("tz", [timezone.utc, timezone(timedelta(hours=2)), None])
+def test_dumps_matches_pydantic_datetimes(tz):
+    message = {"id": "m1", "character_id": "c1", "username": "amy", "text": "hi", "role": "user",
+               "created_at": datetime(2025, 1, 2, 3, 4, 5, 678000, tzinfo=tz)}
+    assert rendering.dumps([message]) == rendering.dumps([MessageOut(**message).model_dump(mode="json")])
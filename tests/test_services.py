@@ -0,0 +1,59 @@
+import base64
+import json
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+
+from services import decode_cursor, encode_cursor, keyset_filter, wants_page
+
+
+def _token(raw) -> str:
+    return base64.urlsafe_b64encode(json.dumps(raw).encode()).decode().rstrip("=")
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2025, 3, 4, 5, 6, 7, 891000, tzinfo=timezone.utc)
+    assert decode_cursor(encode_cursor({"_id": "abc", "created_at": created_at})) == (created_at, "abc")
+
+
+def test_cursor_accepts_naive_and_shaped_documents():
+    naive = datetime(2025, 3, 4, 5, 6, 7, 891000)
+    token = encode_cursor({"id": "abc", "created_at": naive})
+    assert decode_cursor(token) == (naive.replace(tzinfo=timezone.utc), "abc")
+
+
+def test_cursor_truncates_to_milliseconds():
+    created_at = datetime(2025, 3, 4, 5, 6, 7, 891234, tzinfo=timezone.utc)
+    decoded, _ = decode_cursor(encode_cursor({"_id": "x", "created_at": created_at}))
+    assert decoded == created_at.replace(microsecond=891000)
+
+
+@pytest.mark.parametrize("token", [
+    "not base64!",
+    _token("x"),
+    _token([1, 2, 3]),
+    _token([1e300, "x"]),
+    _token([99999999999999999999, "x"]),
+    _token([-99999999999999999, "x"]),
+])
+def test_invalid_cursor_is_400(token):
+    with pytest.raises(HTTPException) as exc:
+        decode_cursor(token)
+    assert exc.value.status_code == 400
+
+
+def test_keyset_filter_breaks_ties_on_id():
+    created_at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    token = encode_cursor({"_id": "m5", "created_at": created_at})
+    assert keyset_filter(token, "$lt") == {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "_id": {"$lt": "m5"}},
+    ]}
+
+
+def test_wants_page():
+    assert not wants_page(1, None, None)
+    assert wants_page(1, 20, None)
+    assert wants_page(1, None, "cursor")
+    assert wants_page(2)
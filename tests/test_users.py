@@ -0,0 +1,33 @@
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_single_upsert_keeps_created_at(db):
+    client = TestClient(main.app)
+    assert client.post("/users", json={"username": "amy", "age": 30}).json()["age"] == 30
+    created_at = db["userprofile"].find_one({"_id": "amy"})["created_at"]
+    assert client.post("/users", json={"username": "amy", "trust_score": 7}).json() == {
+        "username": "amy", "age": None, "trust_score": 7}
+    assert db["userprofile"].count_documents({}) == 1
+    assert db["userprofile"].find_one({"_id": "amy"})["created_at"] == created_at
+
+
+def test_bulk_upsert_counts(db):
+    client = TestClient(main.app)
+    first = client.post("/users/bulk", json=[{"username": "amy"}, {"username": "bob"}])
+    assert first.json() == {"received": 2, "matched": 0, "modified": 0, "upserted": 2}
+
+    second = client.post("/users/bulk", json=[
+        {"username": "amy"}, {"username": "bob", "trust_score": 5}, {"username": "cid"}])
+    assert second.json() == {"received": 3, "matched": 2, "modified": 2, "upserted": 1}
+    assert db["userprofile"].count_documents({}) == 3
+    assert db["userprofile"].find_one({"_id": "bob"})["trust_score"] == 5
+
+
+def test_bulk_upsert_limits(db, monkeypatch):
+    client = TestClient(main.app)
+    assert client.post("/users/bulk", json=[]).json() == {"received": 0, "matched": 0, "modified": 0, "upserted": 0}
+    monkeypatch.setattr(main, "BULK_USERS_MAX", 1)
+    assert client.post("/users/bulk", json=[{"username": "amy"}, {"username": "bob"}]).status_code == 413
+    assert db["userprofile"].count_documents({}) == 0